@@ -1,10 +1,10 @@
-import re
 import html
-import random
+import time
 from typing import List, Tuple, Optional
 from pathlib import Path
 
-from nonebot import on_regex, get_driver, on_command, on_message, on_startswith
+from nonebot import get_driver, on_command, on_message
+from nonebot.message import event_preprocessor
 from nonebot.params import CommandArg, RegexGroup
 from nonebot.typing import T_State, T_Handler
 from nonebot.matcher import Matcher
@@ -16,11 +16,29 @@ from nonebot.adapters.onebot.v11.permission import (
     PRIVATE_FRIEND,
 )
 
-from .utils import parse_msg, get_index_type, get_session_id, save_and_convert_img
+from .utils import (
+    NORMALIZED_MESSAGE,
+    NormalizedMessage,
+    parse_msg,
+    strip_nickname,
+    get_index_type,
+    get_session_id,
+    normalize_message,
+    save_and_convert_img,
+)
 from .config import Config
+from .router import Router
+from .transfer import (
+    ImportProgress,
+    export_dir,
+    import_dir,
+    export_file,
+    import_file,
+    resolve_path,
+)
 from .data_source import cmd
 from .models.word_bank import WordBank
-from .models.typing_models import IndexType, MatchType, WordEntry
+from .models.typing_models import Answer, IndexType, MatchType
 
 last_operation_time = Config.parse_obj(get_driver().config.dict()).last_operation_time
 
@@ -30,20 +48,25 @@ img_dir.mkdir(parents=True, exist_ok=True)
 cmd_list = ["-V", "-v", "-r"]
 
 
+@event_preprocessor
+async def _(event: MessageEvent, state: T_State):
+    # 每个事件只处理一次消息, 各个响应器共用
+    state[NORMALIZED_MESSAGE] = normalize_message(event)
+
+
 async def wb_match_rule(event: MessageEvent, state: T_State) -> bool:
-    index_type = (
-        IndexType.group if isinstance(event, GroupMessageEvent) else IndexType.private
+    message: NormalizedMessage = state.get(NORMALIZED_MESSAGE) or normalize_message(
+        event
     )
-    to_me = False if index_type == IndexType.private else event.is_tome()
-    word_entry: Optional[WordEntry] = await WordBank.match(
-        index_type=index_type,
+    answer: Optional[Answer] = await WordBank.random_answer(
+        index_type=get_index_type(event),
         index_id=get_session_id(event),
-        key=str(event.get_message()),
-        to_me=to_me,
+        key=message.text,
+        to_me=message.to_me,
+        unescaped_key=message.unescaped,
     )
-    # print(word_entry)
-    if word_entry:
-        state["replies"] = word_entry
+    if answer:
+        state["reply"] = answer
         return True
     return False
 
@@ -53,40 +76,31 @@ wb_matcher = on_message(wb_match_rule, priority=99)
 
 @wb_matcher.handle()
 async def handle_wb(event: MessageEvent, state: T_State):
-    we: WordEntry = state["replies"]
-    choices: List[str] = []
-    weights: List[int] = []
-    for ans in we.answer:
-        choices.append(ans.answer)
-        weights.append(ans.weight)
-    msg = random.choices(population=choices, weights=weights, k=1)[0]
-    msg = html.unescape(msg)
+    answer: Answer = state["reply"]
+    msg = html.unescape(answer.answer)
     await wb_matcher.finish(Message(msg))
 
 
 PERM_EDIT = GROUP_ADMIN | GROUP_OWNER | PRIVATE_FRIEND | SUPERUSER
 PERM_GLOBAL = SUPERUSER
 
+# 所有正则命令共用一个响应器, 按注册顺序匹配, 全局命令先于会话命令注册
+router = Router()
+wb_router = on_message(router.rule, priority=10, block=True)
+wb_router.handle()(router.handle)
 
-wb_set_cmd = on_regex(
+
+# 装饰器自下而上注册
+@router.route(
+    ("问", "模糊", "正则", "@"),
     r"^((?:模糊|正则|@)*)\s*问\s*(\S+.*?)\s*答$(\d+)\s*(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=11,
-    permission=PERM_EDIT,
+    PERM_EDIT,
 )
-
-wb_set_cmd_gl = on_regex(
+@router.route(
+    ("问", "全局", "模糊", "正则", "@"),
     r"^((?:全局|模糊|正则|@)*)\s*问\s*(\S+.*?)\s*答\s*(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=10,
-    permission=PERM_GLOBAL,
+    PERM_GLOBAL,
 )
-
-
-@wb_set_cmd.handle()
-@wb_set_cmd_gl.handle()
 async def wb_set(
     bot: Bot,
     event: MessageEvent,
@@ -106,50 +120,32 @@ async def wb_set(
         require_to_me = True
     else:
         # 以昵称开头的词条视为需要to_me
-        for name in bot.config.nickname:
-            if key.startswith(name):
-                key = key.replace(name, "", 1)
-                require_to_me = True
-                break
+        key, require_to_me = strip_nickname(key, bot.config.nickname)
 
     answer = Message(parse_msg(answer))  # 替换/at, /self, /atself
     await save_and_convert_img(answer, img_dir)  # 保存回答中的图片
 
     index_id = get_session_id(event)
     index_type = get_index_type(event)
-    id, created = await WordBank.set(
-        index_type=index_type,
-        index_id=index_id,
-        match_type=match_type,
-        key=key,
-        answer=str(answer),
-        creator_id=str(event.user_id),
-        require_to_me=require_to_me,
-        weight=10,
-    )
+    try:
+        id, created = await WordBank.set(
+            index_type=index_type,
+            index_id=index_id,
+            match_type=match_type,
+            key=key,
+            answer=str(answer),
+            creator_id=str(event.user_id),
+            require_to_me=require_to_me,
+            weight=10,
+        )
+    except ValueError as e:
+        await matcher.finish(str(e))
     if created:
         await matcher.finish(message=f"问答添加成功编号为: {id}")
 
 
-wb_del_cmd = on_regex(
-    r"^删除\s*((?:模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=11,
-    permission=PERM_EDIT,
-)
-
-wb_del_cmd_gl = on_regex(
-    r"^删除\s*((?:全局|模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=10,
-    permission=PERM_GLOBAL,
-)
-
-
-@wb_del_cmd.handle()
-@wb_del_cmd_gl.handle()
+@router.route(("删除",), r"^删除\s*((?:模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*$", PERM_EDIT)
+@router.route(("删除",), r"^删除\s*((?:全局|模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*$", PERM_GLOBAL)
 async def _(
     bot: Bot,
     event: MessageEvent,
@@ -168,11 +164,7 @@ async def _(
     if "@" in flag:
         require_to_me = True
     else:
-        for name in bot.config.nickname:
-            if key.startswith(name):
-                key = key.replace(name, "", 1)
-                require_to_me = True
-                break
+        key, require_to_me = strip_nickname(key, bot.config.nickname)
 
     index_id = get_session_id(event)
     index_type = get_index_type(event)
@@ -265,34 +257,14 @@ async def _(matcher: Matcher, state: T_State):
         await matcher.finish("命令取消")
 
 
-wb_move = on_regex(
-    r"^迁移\s*((?:模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*为(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=11,
-    permission=PERM_EDIT,
-)
+# 迁移词条的消息只拦截, 不做处理, 与原先的行为一致
+router.add(("迁移",), r"^迁移\s*((?:模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*为(\S+.*?)\s*$", PERM_EDIT)
 
-wb_move_gl = on_regex(
-    r"^迁移\s*((?:模糊|正则|@)*)\s*词条\s*(\S+.*?)\s*为(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=10,
-    permission=PERM_EDIT,
-)
-
-
-ans_update = on_regex(
-    r"^更改词条答案\s*(\S+.*?)\s*答\s*(\S+.*?)\s*$",
-    flags=re.S,
-    block=True,
-    priority=10,
-    permission=PERM_EDIT,
-)
 
-
-@ans_update.handle()
+@router.route(("更改词条答案",), r"^更改词条答案\s*(\S+.*?)\s*答\s*(\S+.*?)\s*$", PERM_EDIT)
 async def _(
+    bot: Bot,
+    event: MessageEvent,
     matcher: Matcher,
     matched: Tuple[str, ...] = RegexGroup(),
 ):
@@ -305,11 +277,16 @@ async def _(
     for ans in ans_id_list:
         ans_id_list_.append(int(ans))
     # TODO 修改内容
+    # 答句可能被多个会话共用, 非超级用户只修改本会话的词条
+    is_superuser = await SUPERUSER(bot, event)
     res = await WordBank.update_answer(
-        answer_id_list=ans_id_list_, update_answer=update_ans
+        answer_id_list=ans_id_list_,
+        update_answer=update_ans,
+        index_type=None if is_superuser else get_index_type(event),
+        index_id=None if is_superuser else get_session_id(event),
     )
 
-    if res:
+    if res[1]:
         result = ""
         for id in ans_id_list:
             result += f" {id} "
@@ -317,14 +294,83 @@ async def _(
         await matcher.finish(f"{result}")
 
 
-wb_cmd = on_startswith("#", block=True, priority=10, permission=PERM_EDIT)
+wb_import = on_command("导入词库", block=True, priority=10, permission=PERM_GLOBAL)
 
 
-@wb_cmd.handle()
-async def _(
-    bot: Bot, event: MessageEvent, matcher: Matcher, arg: Message = CommandArg()
-):
-    await wb_cmd.finish(str(await cmd(bot, event, str(arg).strip())))
+@wb_import.handle()
+async def _(event: MessageEvent, matcher: Matcher, arg: Message = CommandArg()):
+    name = arg.extract_plain_text().strip()
+    if not name:
+        await matcher.finish("请指定要导入的 JSONL 或 CSV 文件")
+    path = resolve_path(name, import_dir)
+    if not path.is_file():
+        await matcher.finish(f"文件不存在: {path}")
+
+    progress = ImportProgress()
+    reported = time.monotonic()
+    async for _ in import_file(
+        path,
+        get_index_type(event),
+        get_session_id(event),
+        str(event.user_id),
+        progress,
+    ):
+        if time.monotonic() - reported >= 10:
+            reported = time.monotonic()
+            await matcher.send(f"已导入 {progress.imported} 条词条...")
+
+    result = f"导入完成: 共导入 {progress.imported} 条, 跳过 {progress.skipped} 条"
+    if progress.errors:
+        result += "\n" + "\n".join(progress.errors)
+    await matcher.finish(result)
+
+
+def wb_export(scope: Optional[str] = None) -> T_Handler:
+    async def wb_export_(event: MessageEvent, matcher: Matcher):
+        index_type: Optional[IndexType]
+        if scope == "全局":
+            index_type, index_id, name = IndexType._global, None, "global"
+        elif scope == "全部":
+            index_type, index_id, name = None, None, "all"
+        else:
+            index_type, index_id = get_index_type(event), get_session_id(event)
+            name = f"{index_type.name}_{index_id}"
+        path = export_dir / f"{name}_{time.strftime('%Y%m%d%H%M%S')}.jsonl"
+
+        exported = 0
+        reported = time.monotonic()
+        async for exported in export_file(path, index_type, index_id):
+            if time.monotonic() - reported >= 10:
+                reported = time.monotonic()
+                await matcher.send(f"已导出 {exported} 条词条...")
+        await matcher.finish(f"导出完成: 共导出 {exported} 条, 已保存至 {path}")
+
+    return wb_export_
+
+
+wb_export_cmd = on_command(
+    "导出词库", block=True, priority=10, permission=PERM_GLOBAL, handlers=[wb_export()]
+)
+wb_export_cmd_gl = on_command(
+    "导出全局词库",
+    block=True,
+    priority=10,
+    permission=PERM_GLOBAL,
+    handlers=[wb_export("全局")],
+)
+wb_export_bank = on_command(
+    "导出全部词库",
+    block=True,
+    priority=10,
+    permission=PERM_GLOBAL,
+    handlers=[wb_export("全部")],
+)
+
+
+@router.route(("#",), r"^\s*#", PERM_EDIT)
+async def _(bot: Bot, event: MessageEvent, matcher: Matcher):
+    # 原先的 on_startswith 中 CommandArg 总是为空, 保持原有行为
+    await matcher.finish(str(await cmd(bot, event, "")))
 
 
 # wb_search_cmd = on_regex(
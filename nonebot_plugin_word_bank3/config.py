@@ -1,5 +1,33 @@
+from typing import Literal
+
 from pydantic import Extra, BaseModel
 
 
 class Config(BaseModel, extra=Extra.ignore):
     last_operation_time: int = 10
+    wordbank_regex_cache_size: int = 1024
+    """已编译正则缓存的最大条数"""
+    wordbank_bloom_error_rate: float = 0.001
+    """否定过滤器 (布隆过滤器) 的目标误判率"""
+    wordbank_bloom_max_bytes: int = 4 * 1024 * 1024
+    """否定过滤器的最大内存占用, 超出时误判率会高于目标值"""
+    wordbank_regex_timeout: float = 0.5
+    """单条正则的匹配时间限制 (秒), 超时的词条会被停用. 为 0 时不限制"""
+    wordbank_regex_processes: int = 1
+    """执行正则匹配的子进程数"""
+    wordbank_regex_max_risk: int = 10
+    """添加正则词条时, 回溯风险分达到该值则拒绝添加"""
+    wordbank_match_cache_size: int = 4096
+    """匹配结果缓存的最大条数, 为 0 时不缓存"""
+    wordbank_match_cache_ttl: float = 300
+    """匹配结果缓存的过期时间 (秒)"""
+    wordbank_revision_interval: float = 1
+    """检查其他进程写入的最小间隔 (秒), 为负数时不检查"""
+    wordbank_revision_retention: float = 86400
+    """写入记录的保留时间 (秒)"""
+    wordbank_index_max_buckets: int = 2000
+    """内存中最多保留的会话索引数, 为 0 时不限制, 全局词库不计入"""
+    wordbank_index_max_rows: int = 500000
+    """内存中最多保留的词条数, 为 0 时不限制, 全局词库不计入"""
+    wordbank_match_policy: Literal["union", "tier", "session"] = "union"
+    """匹配结果取舍: union 合并全部结果; tier 按 全匹配/模糊/正则 只取最先有结果的一类; session 会话词库有结果时忽略全局词库"""
@@ -7,14 +7,33 @@ from nonebot import get_driver
 from nonebot.adapters.onebot.v11 import Bot, Message, MessageEvent, GroupMessageEvent
 from nonebot_plugin_tortoise_orm import add_model
 
-from .utils import parse_msg, get_session_id, save_and_convert_img
+from .utils import (
+    parse_msg,
+    strip_nickname,
+    get_session_id,
+    parse_key_flags,
+    save_and_convert_img,
+)
 from .config import Config
+from .models.migration import migrate
+from .models.revision import revision_log
+from .models.regex_sandbox import regex_sandbox
+from .models.negative_filter import negative_filter
 from .models.word_bank import WordBank
-from .models.typing_models import IndexType, MatchType
+from .models.typing_models import IndexType, MatchType, NewWordEntry
 from .models.word_bank_data import WordBankData
 
 add_model("nonebot_plugin_word_bank3.models.word_bank")
 add_model("nonebot_plugin_word_bank3.models.word_bank_data")
+add_model("nonebot_plugin_word_bank3.models.migration")
+add_model("nonebot_plugin_word_bank3.models.revision")
+
+# 在数据库连接后执行, 升级已有的 db.sqlite3
+get_driver().on_startup(migrate)
+get_driver().on_startup(revision_log.start)
+get_driver().on_startup(WordBank.build_negative_filter)
+negative_filter.builder = WordBank.build_negative_filter
+get_driver().on_shutdown(regex_sandbox.close)
 
 last_operation_time = Config.parse_obj(get_driver().config.dict()).last_operation_time
 img_dir = Path("data/wordbank/img").absolute()
@@ -30,9 +49,10 @@ async def special_cmd(
     # 问题答案回退操作
     if cmd == "-V":
         result = "问答"
-        if await WordBank.last_ans_return(index_type, index_id, key) == []:
+        ids = await WordBank.last_ans_return(index_type, index_id, key)
+        if ids == []:
             return "无该编号问答", False
-        for id in await WordBank.last_ans_return(index_type, index_id, key):
+        for id in ids:
             result += str(id)
         result += "已回退完成"
         return result, True
@@ -239,48 +259,29 @@ async def last_cmd_bool(event: MessageEvent) -> str:
 async def add_orm(
     bot: Bot, index_type: IndexType, id: int, user_id: str, list: list[str]
 ):
-    if "@" in list[0]:
-        require_to_me = True
-    else:
-        for name in bot.config.nickname:
-            if list[0].startswith(name):
-                key = list[0].replace(name, "", 1)
-                require_to_me = True
-                break
-    require_to_me = False
-    key = str(list[0])
+    key, is_global, match_type, require_to_me = parse_key_flags(str(list[0]))
+    if not require_to_me:
+        key, require_to_me = strip_nickname(key, bot.config.nickname)
+    if is_global:
+        index_type = IndexType._global
     answer = Message(parse_msg(list[1]))  # 替换/at, /self, /atself
-    match_type = MatchType.congruence
     await save_and_convert_img(answer, img_dir)  # 保存回答中的图片
 
-    if list[0].startswith("qg"):
-        index_type = IndexType._global
-        key = key.replace("qg", "")
-        if list[0].startswith("zz"):
-            match_type = MatchType.regex
-            key = key.replace("zz", "")
-        elif list[0].startswith("mh"):
-            match_type = MatchType.include
-            key = key.replace("mh", "")
-    elif list[0].startswith("zz"):
-        match_type = MatchType.regex
-        key = key.replace("zz", "")
-    elif list[0].startswith("mh"):
-        match_type = MatchType.include
-        key = key.replace("mh", "")
-
-    id, created = await WordBank.set(
-        index_type=index_type,
-        index_id=str(id),
-        match_type=match_type,
-        key=key,
-        answer=answer.extract_plain_text(),
-        creator_id=str(user_id),
-        require_to_me=require_to_me,
-        weight=10,
+    (id,) = await WordBank.bulk_set(
+        [
+            NewWordEntry(
+                index_type=index_type,
+                index_id=str(id),
+                match_type=match_type,
+                key=key,
+                answer=answer.extract_plain_text(),
+                creator_id=str(user_id),
+                require_to_me=require_to_me,
+                weight=10,
+            )
+        ]
     )
-    if created:
-        return f"问答已添加,编号为{id}。"
+    return f"问答已添加,编号为{id}。"
 
 
 # 命令处理函数
@@ -0,0 +1,110 @@
+from typing import Dict, List, Generic, TypeVar
+from collections import deque
+
+T = TypeVar("T")
+
+
+class AhoCorasick(Generic[T]):
+    """
+    :说明: `AhoCorasick`
+    > 多模式子串匹配自动机, 一次扫描即可找出文本中出现的全部模式
+
+    模式插入字典树, 失配指针在 `build` 或下一次查询时统一计算.
+    索引快照不可修改, 词条变化时由 `IndexBucket.evolve` 重新构建整个自动机
+    """
+
+    def __init__(self):
+        self._values: Dict[str, List[T]] = {}
+        """模式 -> 对应的值"""
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._word: List[str] = [""]
+        """节点对应的完整模式, 非模式结尾的节点为空串"""
+        self._dict: List[int] = [0]
+        """沿失配链最近的模式结尾节点"""
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __bool__(self) -> bool:
+        return bool(self._values)
+
+    def add(self, pattern: str, value: T):
+        """
+        :说明: `add`
+        > 添加模式
+
+        :参数:
+          * `pattern: str`: 模式
+          * `value: T`: 命中该模式时返回的值
+        """
+        if pattern in self._values:
+            self._values[pattern].append(value)
+            return
+        self._values[pattern] = [value]
+        self._insert(pattern)
+        self._dirty = True
+
+    def _insert(self, pattern: str):
+        node = 0
+        for char in pattern:
+            if (next_node := self._goto[node].get(char)) is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._word.append("")
+                self._dict.append(0)
+            node = next_node
+        self._word[node] = pattern
+
+    def build(self):
+        """立即计算失配指针, 之后的查询不再修改自动机"""
+        if not self._dirty:
+            return
+        queue = deque(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+            self._dict[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail
+                self._dict[child] = fail if self._word[fail] else self._dict[fail]
+                queue.append(child)
+        self._dirty = False
+
+    def search(self, text: str) -> List[T]:
+        """
+        :说明: `search`
+        > 查找文本中出现的全部模式, 每个模式只返回一次
+
+        :参数:
+          * `text: str`: 文本
+
+        :返回:
+          - `List[T]`: 命中模式对应的值
+        """
+        if not self._values:
+            return []
+        self.build()
+
+        result: List[T] = list(self._values.get("", ()))
+        goto, fail, word, dict_ = self._goto, self._fail, self._word, self._dict
+        seen = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            out = node if word[node] else dict_[node]
+            while out and out not in seen:
+                seen.add(out)
+                result.extend(self._values[word[out]])
+                out = dict_[out]
+        return result
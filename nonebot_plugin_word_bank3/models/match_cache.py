@@ -0,0 +1,92 @@
+import time
+from typing import Set, Dict, List, Tuple, Optional
+from collections import OrderedDict
+
+from nonebot import get_driver
+
+from ..config import Config
+from .typing_models import IndexType
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+CacheKey = Tuple[int, str, str, bool]
+"""(索引类型, 索引ID, 消息, 是否@)"""
+
+
+class MatchCache:
+    """
+    :说明: `MatchCache`
+    > 消息匹配结果的 LRU 缓存, 带过期时间, 写入词库时按索引失效
+
+    未命中任何词条的结果同样会被缓存
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        """每次失效时递增, 计算期间发生失效的结果不会被缓存"""
+        self._cache: "OrderedDict[CacheKey, Tuple[float, tuple]]" = OrderedDict()
+        self._by_index: Dict[Tuple[int, str], Set[CacheKey]] = {}
+
+    def get(self, key: CacheKey) -> Optional[tuple]:
+        if (cached := self._cache.get(key)) is None:
+            self.misses += 1
+            return None
+        expires, value = cached
+        if expires < time.monotonic():
+            self._pop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return value
+
+    def put(self, key: CacheKey, value: List, generation: int):
+        if self.maxsize <= 0 or generation != self.generation:
+            return
+        self._cache[key] = (time.monotonic() + self.ttl, tuple(value))
+        self._cache.move_to_end(key)
+        self._by_index.setdefault(key[:2], set()).add(key)
+        while len(self._cache) > self.maxsize:
+            self._pop(next(iter(self._cache)))
+
+    def _pop(self, key: CacheKey):
+        self._cache.pop(key, None)
+        if keys := self._by_index.get(key[:2]):
+            keys.discard(key)
+            if not keys:
+                del self._by_index[key[:2]]
+
+    def invalidate(
+        self, index_type: Optional[int] = None, index_id: Optional[str] = None
+    ):
+        """
+        :说明: `invalidate`
+        > 使缓存失效. 全局词库会合并到每个会话中, 因此全局词库变化时使全部缓存失效
+
+        :可选参数:
+          * `index_type: Optional[int] = None`: 索引类型
+          * `index_id: Optional[str] = None`: 索引ID
+        """
+        self.generation += 1
+        if index_type == IndexType._global.value or (
+            index_type is None and index_id is None
+        ):
+            self._cache.clear()
+            self._by_index.clear()
+            return
+        for _index_type, _index_id in list(self._by_index):
+            if index_type is not None and _index_type != index_type:
+                continue
+            if index_id is not None and _index_id != str(index_id):
+                continue
+            for key in list(self._by_index.get((_index_type, _index_id), ())):
+                self._pop(key)
+
+
+match_cache = MatchCache(
+    plugin_config.wordbank_match_cache_size, plugin_config.wordbank_match_cache_ttl
+)
@@ -0,0 +1,444 @@
+import re
+import sys
+import random
+import asyncio
+from typing import (
+    TYPE_CHECKING,
+    Set,
+    Dict,
+    List,
+    Tuple,
+    Union,
+    Callable,
+    Iterable,
+    Optional,
+)
+from bisect import bisect_right
+from itertools import accumulate
+from collections import OrderedDict
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from ..config import Config
+from .automaton import AhoCorasick
+from .match_cache import match_cache
+from .regex_cache import regex_cache, required_literal
+from .typing_models import IndexType, MatchType
+
+if TYPE_CHECKING:
+    from .word_bank import WordBank
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+BucketKey = Tuple[int, str, bool]
+"""(索引类型, 索引ID, 是否需要@)"""
+
+GLOBAL_INDEX_ID = ""
+"""全局词库对所有会话生效, 不区分索引ID"""
+
+_BACKGROUND_BUILD = 2000
+"""词条数达到该值的索引在线程池中构建"""
+
+
+def bucket_key(
+    index_type: Union[IndexType, int], index_id: str, require_to_me: bool = False
+) -> BucketKey:
+    if isinstance(index_type, IndexType):
+        index_type = index_type.value
+    if index_type == IndexType._global.value:
+        index_id = GLOBAL_INDEX_ID
+    return index_type, str(index_id), bool(require_to_me)
+
+
+class Entry:
+    """
+    :说明: `Entry`
+    > 内存索引中的词条, 只保留匹配与回复所需的字段
+    """
+
+    __slots__ = (
+        "id",
+        "index_type",
+        "index_id",
+        "match_type",
+        "key",
+        "answer_id",
+        "require_to_me",
+        "weight",
+        "last_cmd",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        index_type: int,
+        index_id: str,
+        match_type: int,
+        key: str,
+        answer_id: int,
+        require_to_me: bool,
+        weight: int,
+        last_cmd: int,
+    ):
+        self.id = id
+        self.index_type = index_type
+        # 同一会话的词条共用同一个字符串
+        self.index_id = sys.intern(str(index_id))
+        self.match_type = match_type
+        self.key = key
+        self.answer_id = answer_id
+        self.require_to_me = bool(require_to_me)
+        self.weight = weight
+        self.last_cmd = last_cmd
+
+    @classmethod
+    def from_row(cls, row: "WordBank") -> "Entry":
+        return cls(*(getattr(row, field) for field in cls.__slots__))
+
+
+class WeightedRows:
+    """
+    :说明: `WeightedRows`
+    > 同一问句下的词条及其累计权重, 词条变化时整体重建
+    """
+
+    __slots__ = ("rows", "cum_weights", "total")
+
+    def __init__(self, rows: Iterable[Entry]):
+        self.rows: Tuple[Entry, ...] = tuple(rows)
+        self.cum_weights: Tuple[int, ...] = tuple(
+            accumulate(row.weight for row in self.rows)
+        )
+        self.total: int = self.cum_weights[-1] if self.cum_weights else 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def pick(self, r: float) -> Entry:
+        """按 `0 <= r < total` 选出词条"""
+        return self.rows[min(bisect_right(self.cum_weights, r), len(self.rows) - 1)]
+
+
+def weighted_pick(tables: List[WeightedRows]) -> Optional[Entry]:
+    """
+    :说明: `weighted_pick`
+    > 在多个问句的匹配结果中按权重选出一个词条
+
+    :参数:
+      * `tables: List[WeightedRows]`: 匹配结果
+
+    :返回:
+      - `Optional[Entry]`: 选中的词条
+    """
+    r = random.random() * sum(table.total for table in tables)
+    for table in tables:
+        if r < table.total:
+            return table.pick(r)
+        r -= table.total
+    return tables[-1].rows[-1] if tables else None
+
+
+class IndexBucket:
+    """
+    :说明: `IndexBucket`
+    > 单个 `(索引类型, 索引ID, 是否需要@)` 下的全部词条, 按 `(匹配类型, 问句)` 分组
+
+    构建后不再修改, 写入时由 `evolve` 生成新的快照, 未变化的自动机直接共用
+    """
+
+    def __init__(self, rows: Iterable[Entry] = ()):
+        self.rows: Dict[int, Entry] = {}
+        """词条ID -> 词条"""
+        self.tables: Dict[Tuple[int, str], WeightedRows] = {}
+        """(匹配类型, 问句) -> 词条"""
+        grouped: Dict[Tuple[int, str], List[Entry]] = {}
+        for row in rows:
+            self.rows[row.id] = row
+            grouped.setdefault((row.match_type, row.key), []).append(row)
+        for table_key, group in grouped.items():
+            self.tables[table_key] = WeightedRows(group)
+        self._index_include()
+        self._index_regex({})
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _index_include(self):
+        self.include: AhoCorasick[str] = AhoCorasick()
+        """模糊匹配: 问句自动机"""
+        for match_type, key in self.tables:
+            if match_type == MatchType.include.value:
+                self.include.add(key, key)
+        self.include.build()
+
+    def _index_regex(self, literals: Dict[str, str]):
+        self.regex_prefilter: AhoCorasick[str] = AhoCorasick()
+        """正则匹配: 必须出现的字面量自动机"""
+        self.regex_unfiltered: Set[str] = set()
+        """正则匹配: 无法提取字面量, 每条消息都需要执行的问句"""
+        self._literals: Dict[str, str] = {}
+        for match_type, key in self.tables:
+            if match_type != MatchType.regex.value:
+                continue
+            literal = literals[key] if key in literals else required_literal(key)
+            if literal:
+                self._literals[key] = literal
+                self.regex_prefilter.add(literal, key)
+            else:
+                self.regex_unfiltered.add(key)
+        self.regex_prefilter.build()
+
+    def evolve(
+        self, added: Iterable[Entry] = (), removed: Iterable[int] = ()
+    ) -> "IndexBucket":
+        """
+        :说明: `evolve`
+        > 生成写入后的新快照, 原快照保持不变
+
+        :可选参数:
+          * `added: Iterable[Entry] = ()`: 新增的词条
+          * `removed: Iterable[int] = ()`: 移除的词条ID
+
+        :返回:
+          - `IndexBucket`: 新快照
+        """
+        bucket = IndexBucket.__new__(IndexBucket)
+        bucket.rows = dict(self.rows)
+        bucket.tables = dict(self.tables)
+        changed: Dict[Tuple[int, str], List[Entry]] = {}
+        for id in removed:
+            if (row := bucket.rows.pop(id, None)) is not None:
+                changed.setdefault((row.match_type, row.key), [])
+        for row in added:
+            bucket.rows[row.id] = row
+            changed.setdefault((row.match_type, row.key), []).append(row)
+
+        reindex: Set[int] = set()
+        for table_key, new_rows in changed.items():
+            table = self.tables.get(table_key)
+            rows = [
+                row
+                for row in (table.rows if table else ())
+                if bucket.rows.get(row.id) is row
+            ]
+            ids = {row.id for row in rows}
+            rows.extend(row for row in new_rows if row.id not in ids)
+            if rows:
+                bucket.tables[table_key] = WeightedRows(rows)
+            else:
+                bucket.tables.pop(table_key, None)
+            if (table_key in self.tables) != bool(rows):
+                reindex.add(table_key[0])
+
+        if MatchType.include.value in reindex:
+            bucket._index_include()
+        else:
+            bucket.include = self.include
+        if MatchType.regex.value in reindex:
+            bucket._index_regex(self._literals)
+        else:
+            bucket.regex_prefilter = self.regex_prefilter
+            bucket.regex_unfiltered = self.regex_unfiltered
+            bucket._literals = self._literals
+        return bucket
+
+    def match(
+        self, key: str, match_type: Optional[MatchType] = None
+    ) -> List[WeightedRows]:
+        """
+        :说明: `match`
+        > 按 全匹配, 模糊匹配 查找词条
+
+        :参数:
+          * `key: str`: 问句
+
+        :可选参数:
+          * `match_type: Optional[MatchType] = None`: 只查找该匹配类型, 为空时查找两种
+
+        :返回:
+          - `List[WeightedRows]`: 匹配到的问句
+        """
+        result: List[WeightedRows] = []
+        if match_type in (None, MatchType.congruence):
+            if table := self.tables.get((MatchType.congruence.value, key)):
+                result.append(table)
+        if match_type in (None, MatchType.include):
+            for include in self.include.search(key):
+                result.append(self.tables[(MatchType.include.value, include)])
+        return result
+
+    def regex_candidates(self, key: str) -> List[Tuple[WeightedRows, re.Pattern]]:
+        """
+        :说明: `regex_candidates`
+        > 只返回必须字面量出现在消息中的正则问句, 由调用方执行正则
+
+        :参数:
+          * `key: str`: 已反转义的问句
+
+        :返回:
+          - `List[Tuple[WeightedRows, re.Pattern]]`: 问句及其已编译的正则
+        """
+        if not self._literals and not self.regex_unfiltered:
+            return []
+        candidates = set(self.regex_prefilter.search(key))
+        candidates.update(self.regex_unfiltered)
+        result: List[Tuple[WeightedRows, re.Pattern]] = []
+        for regex in sorted(candidates):
+            table = self.tables[(MatchType.regex.value, regex)]
+            if (pattern := regex_cache.get(table.rows[0].id, regex)) is not None:
+                result.append((table, pattern))
+        return result
+
+
+async def _build(size: int, func: Callable[..., IndexBucket], *args) -> IndexBucket:
+    """词条较多时在线程池中构建快照, 不阻塞事件循环"""
+    if size < _BACKGROUND_BUILD:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+class MatchIndex:
+    """
+    :说明: `MatchIndex`
+    > 内存中的词库匹配索引, 以 `(索引类型, 索引ID, 是否需要@)` 为键懒加载,
+    > 由 `WordBank` 的写操作保持同步
+
+    每个索引都是不可变快照, 写入时构建新快照后整体替换,
+    匹配时无需加锁, 也不会读到构建一半的索引.
+    超出数量或词条数限制时淘汰最久未使用的会话索引, 全局词库常驻内存
+    """
+
+    def __init__(self, max_buckets: int, max_rows: int):
+        self.max_buckets = max_buckets
+        self.max_rows = max_rows
+        self._buckets: "OrderedDict[BucketKey, IndexBucket]" = OrderedDict()
+        self._pinned: Dict[BucketKey, IndexBucket] = {}
+        """全局词库, 不参与淘汰"""
+        self._rows = 0
+        """可淘汰索引的词条总数"""
+        self._versions: Dict[BucketKey, int] = {}
+        self._generation = 0
+        self._pending: Dict[BucketKey, Tuple[List[Entry], Set[int]]] = {}
+        """尚未构建进快照的写入: (新增的词条, 移除的词条ID)"""
+
+    def get(self, key: BucketKey) -> Optional[IndexBucket]:
+        if key[0] == IndexType._global.value:
+            return self._pinned.get(key)
+        if (bucket := self._buckets.get(key)) is not None:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _peek(self, key: BucketKey) -> Optional[IndexBucket]:
+        """获取索引, 不影响淘汰顺序"""
+        if key[0] == IndexType._global.value:
+            return self._pinned.get(key)
+        return self._buckets.get(key)
+
+    def _store(self, key: BucketKey, bucket: IndexBucket):
+        if key[0] == IndexType._global.value:
+            self._pinned[key] = bucket
+            return
+        if (old := self._buckets.get(key)) is not None:
+            self._rows -= len(old)
+        self._buckets[key] = bucket
+        self._buckets.move_to_end(key)
+        self._rows += len(bucket)
+        evicted = 0
+        while len(self._buckets) > 1 and (
+            (self.max_buckets and len(self._buckets) > self.max_buckets)
+            or (self.max_rows and self._rows > self.max_rows)
+        ):
+            _, old = self._buckets.popitem(last=False)
+            self._rows -= len(old)
+            evicted += 1
+        if evicted:
+            logger.debug(f"已淘汰 {evicted} 个不活跃的词库索引")
+
+    def _remove(self, key: BucketKey):
+        if key[0] == IndexType._global.value:
+            self._pinned.pop(key, None)
+        elif (old := self._buckets.pop(key, None)) is not None:
+            self._rows -= len(old)
+
+    def __len__(self) -> int:
+        return len(self._buckets) + len(self._pinned)
+
+    def __contains__(self, key: BucketKey) -> bool:
+        return self._peek(key) is not None
+
+    def version(self, key: BucketKey) -> Tuple[int, int]:
+        """加载前记录版本, 加载期间若有写入则放弃本次加载结果"""
+        return self._generation, self._versions.get(key, 0)
+
+    async def put(
+        self, key: BucketKey, rows: List[Entry], version: Tuple[int, int]
+    ) -> IndexBucket:
+        bucket = await _build(len(rows), IndexBucket, rows)
+        if self.version(key) == version:
+            self._store(key, bucket)
+        return bucket
+
+    async def _evolve(
+        self,
+        key: BucketKey,
+        added: Iterable[Entry] = (),
+        removed: Iterable[int] = (),
+    ):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        match_cache.invalidate(key[0], key[1])
+        pending_added, pending_removed = self._pending.setdefault(key, ([], set()))
+        removed = set(removed)
+        pending_added[:] = [row for row in pending_added if row.id not in removed]
+        pending_removed.update(removed)
+        for row in added:
+            pending_removed.discard(row.id)
+            pending_added.append(row)
+        while (bucket := self._peek(key)) is not None and key in self._pending:
+            version = self.version(key)
+            _added, _removed = self._pending[key]
+            new = await _build(len(bucket), bucket.evolve, list(_added), set(_removed))
+            if self.version(key) != version or self._peek(key) is not bucket:
+                # 构建期间又有写入, 合并后重新构建
+                continue
+            self._store(key, new)
+            del self._pending[key]
+            # 构建期间读取旧快照得到的结果不能留在缓存中
+            match_cache.invalidate(key[0], key[1])
+        self._pending.pop(key, None)
+
+    async def add(self, row: Entry):
+        key = bucket_key(row.index_type, row.index_id, row.require_to_me)
+        await self._evolve(key, added=[row])
+
+    async def discard(self, key: BucketKey, ids: Iterable[int]):
+        ids = list(ids)
+        regex_cache.discard(ids)
+        await self._evolve(key, removed=ids)
+
+    def invalidate(
+        self, index_type: Optional[int] = None, index_id: Optional[str] = None
+    ):
+        """
+        :说明: `invalidate`
+        > 丢弃缓存, 下次匹配时重新加载. 参数均为空时丢弃全部
+
+        :可选参数:
+          * `index_type: Optional[int] = None`: 索引类型
+          * `index_id: Optional[str] = None`: 索引ID
+        """
+        self._generation += 1
+        match_cache.invalidate(index_type, index_id)
+        if index_type is None and index_id is None:
+            regex_cache.clear()
+        for key in [*self._buckets, *self._pinned]:
+            if index_type is not None and key[0] != index_type:
+                continue
+            if index_id is not None and key[1] != bucket_key(key[0], index_id)[1]:
+                continue
+            self._remove(key)
+
+
+match_index = MatchIndex(
+    plugin_config.wordbank_index_max_buckets, plugin_config.wordbank_index_max_rows
+)
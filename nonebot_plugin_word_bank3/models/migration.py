@@ -0,0 +1,131 @@
+from typing import Set, Dict, Callable, Awaitable
+
+from tortoise import fields
+from tortoise.models import Model
+from nonebot.log import logger
+from tortoise.transactions import in_transaction
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+T_Migration = Callable[[BaseDBAsyncClient], Awaitable[None]]
+
+MIGRATIONS: Dict[int, T_Migration] = {}
+"""版本号 -> 迁移步骤"""
+
+
+class WordBankVersion(Model):
+    id = fields.IntField(pk=True, generated=True)
+    version = fields.IntField()
+    """已应用的迁移版本"""
+    applied_time = fields.DatetimeField(auto_now_add=True)
+    """应用时间"""
+
+    class Meta:
+        table = "wordbank3_version"
+        table_description = "wordbank3 数据库版本"
+
+
+def migration(version: int) -> Callable[[T_Migration], T_Migration]:
+    """
+    :说明: `migration`
+    > 注册一个数据库迁移步骤, 版本号需递增且不可修改已发布的步骤
+
+    :参数:
+      * `version: int`: 迁移后的版本号
+    """
+
+    def decorator(func: T_Migration) -> T_Migration:
+        MIGRATIONS[version] = func
+        return func
+
+    return decorator
+
+
+async def migrate():
+    """
+    :说明: `migrate`
+    > 依次应用未执行的迁移步骤, 每个步骤在独立的事务中执行
+    """
+    latest = await WordBankVersion.all().order_by("-version").first()
+    current = latest.version if latest else 0
+    for version in sorted(v for v in MIGRATIONS if v > current):
+        func = MIGRATIONS[version]
+        async with in_transaction(WordBankVersion._meta.default_connection) as conn:
+            await func(conn)
+            await WordBankVersion.create(version=version, using_db=conn)
+        logger.info(f"词库数据库已迁移至版本 {version}: {func.__doc__}")
+
+
+@migration(1)
+async def _(conn: BaseDBAsyncClient):
+    """为 wordbank3 添加匹配与答句ID索引"""
+    if conn.capabilities.dialect == "mysql":
+        statements = [
+            "CREATE INDEX idx_wordbank3_match ON wordbank3 "
+            "(index_type, index_id(191), match_type, require_to_me, `key`(191))",
+            "CREATE INDEX idx_wordbank3_answer_id ON wordbank3 (answer_id)",
+        ]
+    else:
+        statements = [
+            "CREATE INDEX IF NOT EXISTS idx_wordbank3_match ON wordbank3 "
+            '(index_type, index_id, match_type, require_to_me, "key")',
+            "CREATE INDEX IF NOT EXISTS idx_wordbank3_answer_id "
+            "ON wordbank3 (answer_id)",
+        ]
+    for sql in statements:
+        await conn.execute_query(sql)
+
+
+async def _columns(conn: BaseDBAsyncClient, table: str) -> Set[str]:
+    """表中已有的列名"""
+    if conn.capabilities.dialect == "sqlite":
+        sql = f"SELECT name FROM pragma_table_info('{table}')"
+    else:
+        sql = (
+            "SELECT column_name AS name FROM information_schema.columns "
+            f"WHERE table_name = '{table}'"
+        )
+    return {row["name"] for row in await conn.execute_query_dict(sql)}
+
+
+@migration(2)
+async def _(conn: BaseDBAsyncClient):
+    """为 wordbank3_data 添加内容哈希, 合并重复答句并删除无引用的答句"""
+    from .word_bank_data import WordBankData, answer_hash
+
+    mysql = conn.capabilities.dialect == "mysql"
+    if "hash" not in await _columns(conn, "wordbank3_data"):
+        await conn.execute_query(
+            "ALTER TABLE wordbank3_data ADD COLUMN hash VARCHAR(64) NULL"
+        )
+
+    last_id = 0
+    while page := (
+        await WordBankData.filter(id__gt=last_id)
+        .using_db(conn)
+        .order_by("id")
+        .limit(1000)
+    ):
+        for data in page:
+            data.hash = answer_hash(data.answer)
+        await WordBankData.bulk_update(page, ["hash"], using_db=conn)
+        last_id = page[-1].id
+
+    # 相同内容的答句合并到ID最小的一条
+    drop = "DROP INDEX idx_wordbank3_data_dedupe"
+    statements = [
+        "CREATE INDEX idx_wordbank3_data_dedupe ON wordbank3_data (hash)",
+        "UPDATE wordbank3 SET answer_id = ("
+        "SELECT MIN(b.id) FROM wordbank3_data a "
+        "JOIN wordbank3_data b ON b.hash = a.hash "
+        "WHERE a.id = wordbank3.answer_id) "
+        "WHERE answer_id IN (SELECT id FROM wordbank3_data)",
+        f"{drop} ON wordbank3_data" if mysql else drop,
+        "DELETE FROM wordbank3_data WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM wordbank3_data GROUP BY hash) "
+        "AS keep)",
+        "DELETE FROM wordbank3_data WHERE id NOT IN ("
+        "SELECT answer_id FROM wordbank3)",
+        "CREATE UNIQUE INDEX idx_wordbank3_data_hash ON wordbank3_data (hash)",
+    ]
+    for sql in statements:
+        await conn.execute_query(sql)
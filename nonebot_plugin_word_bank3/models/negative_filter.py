@@ -0,0 +1,181 @@
+import math
+import asyncio
+from typing import Set, List, Tuple, Callable, Iterable, Optional, Awaitable
+from hashlib import blake2b
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from ..config import Config
+from .match_index import BucketKey
+from .typing_models import MatchType
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+
+class BloomFilter:
+    """
+    :说明: `BloomFilter`
+    > 布隆过滤器, 判断为不存在时一定不存在
+    """
+
+    def __init__(self, capacity: int, error_rate: float, max_bytes: int):
+        capacity = max(capacity, 1)
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(min(bits, max_bytes * 8), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item)
+        )
+
+    def error_rate(self) -> float:
+        """按当前元素数估算的误判率"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+def _item(key: BucketKey, text: str) -> str:
+    return f"{key[0]}\0{key[1]}\0{int(key[2])}\0{text}"
+
+
+class NegativeFilter:
+    """
+    :说明: `NegativeFilter`
+    > 未加载索引的快速否定判断
+
+    全匹配问句放入布隆过滤器, 含模糊/正则词条的索引单独记录.
+    消息既不可能命中全匹配, 索引中也没有模糊/正则词条时, 无需从数据库加载该索引.
+    容量用尽时停用, 并在后台按当前词条数重新构建
+    """
+
+    def __init__(self):
+        self.builder: Optional[Callable[[], Awaitable[None]]] = None
+        """重建过滤器的函数, 未设置时停用后不会自动重建"""
+        self._task: Optional[asyncio.Task] = None
+        self._bloom: Optional[BloomFilter] = None
+        self._fuzzy: Set[BucketKey] = set()
+        """含有模糊/正则词条的索引"""
+        self._pending: Optional[List[Tuple[BucketKey, Optional[int], str]]] = None
+        """构建期间发生的写入, 构建完成后补上"""
+
+    def may_match(self, key: BucketKey, text: str) -> bool:
+        """
+        :说明: `may_match`
+        > 索引中是否可能有词条匹配该消息, 未构建时总是返回 `True`
+
+        :参数:
+          * `key: BucketKey`: 索引
+          * `text: str`: 消息
+        """
+        if self._bloom is None or key in self._fuzzy:
+            return True
+        return _item(key, text) in self._bloom
+
+    def add(self, key: BucketKey, match_type: int, text: str):
+        """
+        :说明: `add`
+        > 记录已提交的新增问句, 需在写入事务提交后调用, 重建时才不会遗漏
+        """
+        if match_type != MatchType.congruence.value:
+            self._fuzzy.add(key)
+        elif self._bloom is not None:
+            if self._bloom.count >= self._bloom.capacity:
+                # 超出容量后误判率失控, 停用并按新的词条数重建
+                logger.warning("词库否定过滤器已满, 正在后台重建")
+                self.rebuild()
+            else:
+                self._bloom.add(_item(key, text))
+        if self._pending is not None:
+            self._pending.append((key, match_type, text))
+
+    def add_bucket(self, key: BucketKey):
+        """索引中新增了未逐条记录的问句, 下次构建前视为可能匹配"""
+        self._fuzzy.add(key)
+        if self._pending is not None:
+            self._pending.append((key, None, ""))
+
+    def reset(self):
+        """停用过滤器直至下次构建"""
+        self._bloom = None
+        self._fuzzy = set()
+
+    def rebuild(self):
+        """
+        :说明: `rebuild`
+        > 停用过滤器并在后台调用 `builder` 重建, 期间所有索引都视为可能匹配
+        """
+        self.reset()
+        if self.builder is None or self._task is not None:
+            return
+        # 从此刻起的写入都会在构建完成时补上, 之前的写入已提交, 构建时能读到
+        self._pending = []
+        self._task = asyncio.get_running_loop().create_task(self._rebuild())
+
+    async def _rebuild(self):
+        try:
+            await self.builder()  # type: ignore
+        except Exception as e:
+            self._pending = None
+            logger.opt(exception=e).error("词库否定过滤器重建失败, 保持停用")
+        finally:
+            self._task = None
+
+    def build(self, congruence: int) -> "FilterBuilder":
+        """
+        :说明: `build`
+        > 开始重建过滤器, 构建期间的写入会在完成时补上
+
+        :参数:
+          * `congruence: int`: 全匹配词条数
+        """
+        if self._pending is None:
+            self._pending = []
+        return FilterBuilder(self, congruence)
+
+
+class FilterBuilder:
+    def __init__(self, target: NegativeFilter, congruence: int):
+        self.target = target
+        self.bloom = BloomFilter(
+            # 预留一倍容量给之后新增的词条
+            capacity=congruence * 2 + 1024,
+            error_rate=plugin_config.wordbank_bloom_error_rate,
+            max_bytes=plugin_config.wordbank_bloom_max_bytes,
+        )
+        self.fuzzy: Set[BucketKey] = set()
+
+    def add(self, key: BucketKey, match_type: Optional[int], text: str):
+        if match_type != MatchType.congruence.value:
+            self.fuzzy.add(key)
+        else:
+            self.bloom.add(_item(key, text))
+
+    def finish(self):
+        for key, match_type, text in self.target._pending or ():
+            self.add(key, match_type, text)
+        self.target._pending = None
+        self.target._bloom = self.bloom
+        self.target._fuzzy = self.fuzzy
+        logger.info(
+            f"词库否定过滤器已构建: {self.bloom.count} 条全匹配, "
+            f"{len(self.fuzzy)} 个模糊/正则索引, {len(self.bloom._bits)} 字节, "
+            f"预计误判率 {self.bloom.error_rate():.4%}"
+        )
+
+
+negative_filter = NegativeFilter()
@@ -0,0 +1,216 @@
+import re
+from typing import Set, Dict, List, Tuple, Iterable, Optional, NamedTuple
+from collections import OrderedDict
+
+try:
+    from re import _parser as sre_parse  # type: ignore
+except ImportError:  # Python < 3.11
+    import sre_parse  # type: ignore
+
+from nonebot import get_driver
+from nonebot.log import logger
+from nonebot.adapters.onebot.v11.utils import unescape
+
+from ..config import Config
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class RegexCache:
+    """
+    :说明: `RegexCache`
+    > 以词条ID为键的已编译正则 LRU 缓存
+
+    无法编译的正则同样会被缓存 (值为 `None`), 不会在每条消息上重复编译和报错
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[int, Tuple[str, Optional[re.Pattern]]]" = (
+            OrderedDict()
+        )
+
+    def get(self, id: int, key: str) -> Optional[re.Pattern]:
+        """
+        :说明: `get`
+        > 获取词条对应的已编译正则
+
+        :参数:
+          * `id: int`: 词条ID
+          * `key: str`: 问句 (正则)
+
+        :返回:
+          - `Optional[re.Pattern]`: 已编译的正则, 无法编译时为 `None`
+        """
+        if (cached := self._cache.get(id)) is not None and cached[0] == key:
+            self.hits += 1
+            self._cache.move_to_end(id)
+            return cached[1]
+
+        self.misses += 1
+        try:
+            pattern = re.compile(unescape(key), re.S)
+        except re.error as e:
+            logger.warning(f"词条 {id} 的正则 {key} 无法编译: {e}")
+            pattern = None
+        self._cache[id] = (key, pattern)
+        self._cache.move_to_end(id)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return pattern
+
+    def discard(self, ids: Iterable[int]):
+        for id in ids:
+            self._cache.pop(id, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+
+def _literals(parsed, flags: int) -> List[str]:
+    """收集正则语法树中必须出现的连续字面量"""
+    if flags & re.I:
+        return []
+    result: List[str] = []
+    run: List[str] = []
+
+    def end_run():
+        if run:
+            result.append("".join(run))
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        end_run()
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, _, sub = av
+            result.extend(_literals(sub, flags | add_flags))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            min_, _, sub = av
+            if min_ >= 1:
+                result.extend(_literals(sub, flags))
+    end_run()
+    return result
+
+
+def required_literal(key: str) -> str:
+    """
+    :说明: `required_literal`
+    > 提取正则问句中必须出现的最长字面量, 用于在执行正则前预筛选消息
+
+    :参数:
+      * `key: str`: 问句 (正则)
+
+    :返回:
+      - `str`: 必须出现的字面量, 无法确定时为空串
+    """
+    try:
+        parsed = sre_parse.parse(unescape(key), re.S)
+    except (re.error, RecursionError, OverflowError):
+        return ""
+    return max(_literals(parsed, parsed.state.flags), key=len, default="")
+
+
+_LARGE_REPEAT = 32
+"""上限不小于该值的量词视为无界"""
+
+
+def _first_chars(branch) -> Optional[Set[int]]:
+    """分支可能的首字符, 无法确定时为 `None`"""
+    if not branch:
+        return None
+    op, av = branch[0]
+    if op is sre_parse.LITERAL:
+        return {av}
+    if op is sre_parse.IN:
+        chars: Set[int] = set()
+        for item_op, item_av in av:
+            if item_op is sre_parse.LITERAL:
+                chars.add(item_av)
+            elif item_op is sre_parse.RANGE and item_av[1] - item_av[0] < 256:
+                chars.update(range(item_av[0], item_av[1] + 1))
+            else:
+                return None
+        return chars
+    if op is sre_parse.SUBPATTERN:
+        return _first_chars(av[3])
+    return None
+
+
+def _overlapping(branches) -> bool:
+    """分支之间是否可能从同一个字符开始匹配"""
+    seen: Set[int] = set()
+    for branch in branches:
+        if (chars := _first_chars(branch)) is None or seen & chars:
+            return True
+        seen |= chars
+    return False
+
+
+def _risk(parsed, in_repeat: bool) -> int:
+    score = 0
+    for op, av in parsed:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            _, max_, sub = av
+            unbounded = max_ is sre_parse.MAXREPEAT or max_ >= _LARGE_REPEAT
+            if unbounded and in_repeat:
+                # 嵌套的无界量词, 如 (a+)+
+                score += 10
+            score += _risk(sub, in_repeat or unbounded)
+        elif op is sre_parse.BRANCH:
+            _, branches = av
+            if in_repeat and _overlapping(branches):
+                # 量词中的分支可能匹配同一段文本, 如 (a|ab)*
+                score += 5
+            score += sum(_risk(branch, in_repeat) for branch in branches)
+        elif op is sre_parse.SUBPATTERN:
+            score += _risk(av[3], in_repeat)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            score += _risk(av[1], in_repeat)
+        elif op is sre_parse.GROUPREF:
+            score += 2
+    return score
+
+
+def validate_regex(key: str) -> int:
+    """
+    :说明: `validate_regex`
+    > 检查正则问句能否编译, 并按嵌套量词, 重叠分支等特征评估回溯风险
+
+    :参数:
+      * `key: str`: 问句 (正则)
+
+    :返回:
+      - `int`: 风险分, 为 0 时没有发现风险
+
+    :Exceptions:
+      * `ValueError`: 无法编译, 或风险分达到 `wordbank_regex_max_risk`
+    """
+    try:
+        parsed = sre_parse.parse(unescape(key), re.S)
+        re.compile(unescape(key), re.S)
+    except (re.error, RecursionError, OverflowError) as e:
+        raise ValueError(f"正则表达式有误: {e}") from None
+    risk = _risk(parsed, False)
+    if risk >= plugin_config.wordbank_regex_max_risk:
+        raise ValueError("正则表达式可能导致灾难性回溯 (如嵌套的量词), 请修改后重试")
+    if risk:
+        logger.warning(f"正则 {key} 存在回溯风险 (风险分 {risk})")
+    return risk
+
+
+regex_cache = RegexCache(plugin_config.wordbank_regex_cache_size)
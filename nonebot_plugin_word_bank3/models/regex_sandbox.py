@@ -0,0 +1,194 @@
+import re
+import time
+import asyncio
+import multiprocessing
+from typing import Set, List, Tuple, Optional
+from collections import OrderedDict
+from multiprocessing.pool import Pool
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from ..config import Config
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+
+_compiled: "OrderedDict[Tuple[str, int], re.Pattern]" = OrderedDict()
+"""子进程中的已编译正则 LRU 缓存, 不受 `re` 模块 512 条缓存的限制"""
+
+
+def _search_many(
+    patterns: List[Tuple[str, int]], text: str, timeout: float = 0
+) -> List[Optional[bool]]:
+    """
+    在子进程中依次执行一条消息的全部候选正则,
+    单条正则用时超出 `timeout` 时即使完成匹配也记为 `None`
+    """
+    result: List[Optional[bool]] = []
+    for item in patterns:
+        if (pattern := _compiled.get(item)) is None:
+            pattern = _compiled[item] = re.compile(*item)
+            while len(_compiled) > plugin_config.wordbank_regex_cache_size:
+                _compiled.popitem(last=False)
+        else:
+            _compiled.move_to_end(item)
+        start = time.perf_counter()
+        found = pattern.search(text) is not None
+        if timeout > 0 and time.perf_counter() - start > timeout:
+            result.append(None)
+        else:
+            result.append(found)
+    return result
+
+
+class RegexTimeout(Exception):
+    """正则匹配超出时间限制"""
+
+
+class RegexAborted(Exception):
+    """其他匹配超时导致子进程池被结束, 本次匹配没有结果"""
+
+
+class RegexSandbox:
+    """
+    :说明: `RegexSandbox`
+    > 在子进程池中执行正则匹配, 超出时间限制的子进程会被直接结束,
+    > 灾难性回溯不会阻塞事件循环
+
+    一条消息的全部候选正则在一次调用中发给子进程, 子进程缓存已编译的正则.
+    时间限制按正则条数放大, 子进程另外记录每条正则的用时.
+    仅支持 `fork` 的平台可用, 其余平台退回到在当前进程中匹配.
+    fork 时主进程中可能已有其他线程 (数据库连接, 索引构建), 子进程只执行 `re`,
+    不会用到这些线程持有的锁
+    """
+
+    def __init__(self, timeout: float, processes: int):
+        self.timeout = timeout
+        self.processes = max(processes, 1)
+        self.enabled = timeout > 0 and "fork" in multiprocessing.get_all_start_methods()
+        self._pool: Optional[Pool] = None
+        self._pending: Set[asyncio.Future] = set()
+        """等待结果的匹配"""
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def _get_pool(self) -> Pool:
+        """创建子进程池, fork 在线程池中执行, 不阻塞事件循环"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if (pool := self._pool) is None:
+                pool = self._pool = await asyncio.get_running_loop().run_in_executor(
+                    None, multiprocessing.get_context("fork").Pool, self.processes
+                )
+        return pool
+
+    def _reset(self):
+        """结束全部子进程, 正在等待的匹配视为被中断"""
+        if self._pool is not None:
+            # terminate 会等待子进程退出, 放到线程池中执行
+            asyncio.get_running_loop().run_in_executor(None, self._pool.terminate)
+            self._pool = None
+        for future in self._pending:
+            if not future.done():
+                future.set_exception(RegexAborted())
+        self._pending.clear()
+
+    async def search_many(
+        self, patterns: List[re.Pattern], text: str
+    ) -> List[Optional[bool]]:
+        """
+        :说明: `search_many`
+        > 在时间限制内执行一条消息的全部候选正则
+
+        整批超时后逐条重新执行, 找出超时的正则
+
+        :参数:
+          * `patterns: List[re.Pattern]`: 已编译的正则
+          * `text: str`: 消息
+
+        :返回:
+          - `List[Optional[bool]]`: 与 `patterns` 一一对应是否匹配, 超出时间限制时为 `None`
+
+        :异常:
+          - `RegexAborted`: 其他匹配超时导致本次匹配重试后仍被中断
+        """
+        if not patterns:
+            return []
+        if not self.enabled:
+            return [pattern.search(text) is not None for pattern in patterns]
+        try:
+            return await self._retry(patterns, text)
+        except RegexTimeout:
+            if len(patterns) == 1:
+                return [None]
+        result: List[Optional[bool]] = []
+        for pattern in patterns:
+            try:
+                result.extend(await self._retry([pattern], text))
+            except RegexTimeout:
+                result.append(None)
+        return result
+
+    async def _retry(
+        self, patterns: List[re.Pattern], text: str
+    ) -> List[Optional[bool]]:
+        """被其他匹配的超时中断时重新提交一次"""
+        try:
+            return await self._submit(patterns, text)
+        except RegexAborted:
+            return await self._submit(patterns, text)
+
+    async def _submit(
+        self, patterns: List[re.Pattern], text: str
+    ) -> List[Optional[bool]]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.processes)
+        # 只在有空闲子进程时提交, 排队时间不计入时间限制
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            future: asyncio.Future = loop.create_future()
+
+            def callback(result: List[Optional[bool]]):
+                if not future.done():
+                    future.set_result(result)
+
+            def error_callback(e: BaseException):
+                if not future.done():
+                    future.set_exception(e)
+
+            pool = await self._get_pool()
+            self._pending.add(future)
+            pool.apply_async(
+                _search_many,
+                (
+                    [(pattern.pattern, pattern.flags) for pattern in patterns],
+                    text,
+                    self.timeout,
+                ),
+                callback=lambda r: loop.call_soon_threadsafe(callback, r),
+                error_callback=lambda e: loop.call_soon_threadsafe(error_callback, e),
+            )
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(future), self.timeout * len(patterns)
+                )
+            except asyncio.TimeoutError:
+                self._pending.discard(future)
+                self._reset()
+                raise RegexTimeout(
+                    ", ".join(pattern.pattern for pattern in patterns)
+                ) from None
+            finally:
+                self._pending.discard(future)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+regex_sandbox = RegexSandbox(
+    plugin_config.wordbank_regex_timeout, plugin_config.wordbank_regex_processes
+)
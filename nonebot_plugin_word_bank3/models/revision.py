@@ -0,0 +1,224 @@
+import time
+from uuid import uuid4
+from typing import Set, List, Tuple, Iterable, Optional
+from datetime import timedelta
+
+from tortoise import fields, timezone
+from nonebot import get_driver
+from nonebot.log import logger
+from tortoise.models import Model
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from ..config import Config
+from .match_index import BucketKey, bucket_key, match_index
+from .negative_filter import negative_filter
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
+
+_PRUNE_INTERVAL = 3600
+"""清理过期写入记录的最小间隔 (秒)"""
+
+
+class WordBankRevision(Model):
+    id = fields.BigIntField(pk=True)
+    """修订号, 单调递增"""
+    index_type = fields.SmallIntField(null=True)
+    """索引类型, 为空时表示全部"""
+    index_id = fields.TextField(null=True)
+    """索引ID, 为空时表示全部"""
+    require_to_me = fields.BooleanField(null=True)
+    """新增问句是否需要@"""
+    match_type = fields.SmallIntField(null=True)
+    """新增问句的匹配类型"""
+    key = fields.TextField(null=True)
+    """新增的问句, 为空时仅表示索引有变化; `require_to_me` 不为空时表示批量新增"""
+    origin = fields.CharField(max_length=32)
+    """写入的进程"""
+    create_time = fields.DatetimeField(auto_now_add=True)
+    """写入时间"""
+
+    class Meta:
+        table = "wordbank3_revision"
+        table_description = "wordbank3 写入记录"
+
+
+class RevisionLog:
+    """
+    :说明: `RevisionLog`
+    > 多个进程共用同一数据库时的缓存同步
+
+    每次写入词库时追加一条写入记录, 匹配前按间隔读取其他进程的新记录,
+    只丢弃受影响索引的缓存, 并把新增的问句补进否定过滤器
+    """
+
+    def __init__(self, interval: float, retention: float):
+        self.interval = interval
+        self.retention = retention
+        self.origin = uuid4().hex
+        """本进程的标识, 读取时跳过本进程的记录"""
+        self._last: Optional[int] = None
+        self._polled = 0.0
+        self._pruned = 0.0
+
+    async def start(self):
+        """
+        :说明: `start`
+        > 记录当前修订号, 并清理过期的写入记录
+        """
+        await self._prune()
+        latest = await WordBankRevision.all().order_by("-id").first()
+        self._last = latest.id if latest else 0
+        self._polled = time.monotonic()
+
+    async def _prune(self):
+        """删除超过保留时间的写入记录"""
+        self._pruned = time.monotonic()
+        await WordBankRevision.filter(
+            create_time__lt=timezone.now() - timedelta(seconds=self.retention)
+        ).delete()
+
+    async def touch(
+        self,
+        index_type: Optional[int] = None,
+        index_id: Optional[str] = None,
+        using_db: Optional[BaseDBAsyncClient] = None,
+    ):
+        """
+        :说明: `touch`
+        > 记录索引有变化, 参数均为空时表示全部索引
+
+        :可选参数:
+          * `index_type: Optional[int] = None`: 索引类型
+          * `index_id: Optional[str] = None`: 索引ID
+          * `using_db: Optional[BaseDBAsyncClient] = None`: 在该连接 (事务) 中写入
+        """
+        await WordBankRevision.create(
+            index_type=index_type,
+            index_id=None if index_id is None else str(index_id),
+            origin=self.origin,
+            using_db=using_db,
+        )
+
+    async def added(
+        self,
+        key: BucketKey,
+        match_type: int,
+        texts: Iterable[str],
+        using_db: Optional[BaseDBAsyncClient] = None,
+    ):
+        """
+        :说明: `added`
+        > 记录索引中新增的问句
+
+        :参数:
+          * `key: BucketKey`: 索引
+          * `match_type: int`: 匹配类型
+          * `texts: Iterable[str]`: 问句
+
+        :可选参数:
+          * `using_db: Optional[BaseDBAsyncClient] = None`: 在该连接 (事务) 中写入
+        """
+        await WordBankRevision.bulk_create(
+            [
+                WordBankRevision(
+                    index_type=key[0],
+                    index_id=key[1],
+                    require_to_me=key[2],
+                    match_type=match_type,
+                    key=text,
+                    origin=self.origin,
+                )
+                for text in texts
+            ],
+            using_db=using_db,
+        )
+
+    async def bulk_added(
+        self, keys: Iterable[BucketKey], using_db: Optional[BaseDBAsyncClient] = None
+    ):
+        """
+        :说明: `bulk_added`
+        > 记录索引中批量新增了问句, 每个索引只写一条记录,
+        > 其他进程在下次构建否定过滤器前把该索引视为可能匹配
+
+        :参数:
+          * `keys: Iterable[BucketKey]`: 索引
+
+        :可选参数:
+          * `using_db: Optional[BaseDBAsyncClient] = None`: 在该连接 (事务) 中写入
+        """
+        await WordBankRevision.bulk_create(
+            [
+                WordBankRevision(
+                    index_type=key[0],
+                    index_id=key[1],
+                    require_to_me=key[2],
+                    origin=self.origin,
+                )
+                for key in keys
+            ],
+            using_db=using_db,
+        )
+
+    async def poll(self):
+        """
+        :说明: `poll`
+        > 距上次读取超过间隔时, 应用其他进程的写入记录.
+        > 长时间运行时也会定期清理过期的写入记录
+        """
+        now = time.monotonic()
+        if now - self._pruned >= min(self.retention, _PRUNE_INTERVAL):
+            await self._prune()
+        if self.interval < 0:
+            return
+        if self._last is not None and now - self._polled < self.interval:
+            return
+        idle = now - self._polled
+        self._polled = now
+        if self._last is None:
+            latest = await WordBankRevision.all().order_by("-id").first()
+            self._last = latest.id if latest else 0
+            return
+
+        records: List[Tuple] = await (
+            WordBankRevision.filter(id__gt=self._last)
+            .order_by("id")
+            .values_list(
+                "id",
+                "index_type",
+                "index_id",
+                "require_to_me",
+                "match_type",
+                "key",
+                "origin",
+            )
+        )
+        if idle > self.retention:
+            # 期间的记录可能已被其他进程清理
+            logger.warning("词库写入记录可能已过期, 丢弃全部缓存")
+            match_index.invalidate()
+            negative_filter.rebuild()
+        changed: Set[Tuple[Optional[int], Optional[str]]] = set()
+        for id, index_type, index_id, to_me, match_type, key, origin in records:
+            self._last = id
+            if origin == self.origin:
+                continue
+            changed.add((index_type, index_id))
+            if key is not None:
+                negative_filter.add(
+                    bucket_key(index_type, index_id, to_me), match_type, key
+                )
+            elif to_me is not None:
+                negative_filter.add_bucket(bucket_key(index_type, index_id, to_me))
+        if (None, None) in changed:
+            changed = {(None, None)}
+        for index_type, index_id in changed:
+            match_index.invalidate(index_type, index_id)
+        if changed:
+            logger.debug(f"已同步其他进程的词库写入: {len(changed)} 个索引")
+
+
+revision_log = RevisionLog(
+    plugin_config.wordbank_revision_interval,
+    plugin_config.wordbank_revision_retention,
+)
@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 
 class MatchType(Enum):
@@ -47,3 +47,29 @@ class WordEntry(BaseModel):
     key: str
     answer: List[Answer]
     require_to_me: bool
+
+
+class NewWordEntry(BaseModel):
+    """批量添加的词条"""
+
+    index_type: IndexType
+    index_id: str
+    match_type: MatchType = MatchType.congruence
+    key: str
+    answer: str
+    creator_id: str
+    require_to_me: bool = False
+    weight: int = 10
+
+    @validator("key", allow_reuse=True)
+    def check_key(cls, key: str) -> str:
+        # 去掉 qg/mh 等标记后可能为空, 空问句的模糊匹配会命中所有消息
+        if not key:
+            raise ValueError("问句不能为空")
+        return key
+
+    @validator("weight", allow_reuse=True)
+    def check_weight(cls, weight: int) -> int:
+        if weight < 1 or weight > 10:
+            raise ValueError("权重必须为 1~10 的整数")
+        return weight
@@ -1,13 +1,42 @@
-import re
-from typing import List, Tuple, Optional
+from typing import Any, Set, Dict, List, Tuple, Iterable, Optional, AsyncIterator
 from datetime import datetime
+from itertools import islice
 
 from tortoise import fields
+from nonebot import get_driver
+from tortoise.expressions import Q
+from nonebot.log import logger
 from tortoise.models import Model
+from tortoise.transactions import in_transaction
+from tortoise.backends.base.client import BaseDBAsyncClient
 from nonebot.adapters.onebot.v11.utils import unescape
 
-from .typing_models import Answer, CmdType, IndexType, MatchType, WordEntry
-from .word_bank_data import WordBankData
+from ..config import Config
+from .match_index import (
+    Entry,
+    BucketKey,
+    IndexBucket,
+    WeightedRows,
+    bucket_key,
+    match_index,
+    weighted_pick,
+)
+from .match_cache import match_cache
+from .regex_cache import regex_cache, validate_regex
+from .regex_sandbox import RegexAborted, regex_sandbox
+from .revision import revision_log
+from .negative_filter import negative_filter
+from .typing_models import (
+    Answer,
+    CmdType,
+    IndexType,
+    MatchType,
+    WordEntry,
+    NewWordEntry,
+)
+from .word_bank_data import WordBankData, answer_hash
+
+plugin_config = Config.parse_obj(get_driver().config.dict())
 
 
 class WordBank(Model):
@@ -43,6 +72,7 @@ class WordBank(Model):
     class Meta:
         table = "wordbank3"
         table_description = "wordbank3 数据库"
+        # 索引由 models/migration.py 创建
 
     @staticmethod
     async def match(
@@ -50,6 +80,7 @@ class WordBank(Model):
         index_id: str,
         key: str,
         to_me: bool = False,
+        unescaped_key: Optional[str] = None,
     ) -> Optional[WordEntry]:
         """
         :说明: `match`
@@ -62,105 +93,298 @@ class WordBank(Model):
 
         :可选参数:
           * `to_me: bool = False`: 是否需要@
+          * `unescaped_key: Optional[str] = None`: 已反转义的问句, 为空时由 `key` 反转义
 
         :返回:
           - `Optional[WordEntry]`: 如匹配到词条则返回结果
         """
-        # 下面这个尝试用for来遍历, 但是有问题 >_<
-        # for mt in MatchType:
-        #     if wb_list := await WordBank.filter(
-        #         index_type=index_type.value,
-        #         index_id=index_id,
-        #         match_type=mt.value,
-        #         require_to_me=to_me,
-        #     ):
-        #         for wb_ans in wb_list:
-        #             if mt == MatchType.congruence and wb_ans.key == key:
-        #                 pass
-        #             elif mt == MatchType.include and (wb_ans.key in key):
-        #                 pass
-        #             elif mt == MatchType.regex and regex_match(wb_ans.key, key):
-        #                 pass
-        #             else:
-        #                 continue
-        #             data = await WordBankData.get(id=wb_ans.answer_id)
-        #             answers.append(Answer(answer=data.answer, weight=wb_ans.weight))
-
-        #     return (
-        #         WordEntry(key=key, answer=answers, require_to_me=to_me)
-        #         if answers
-        #         else None
-        #     )
-
-        # 下面把每个类型都查询一下
-        async def _match(index_type: IndexType) -> WordEntry:
-            answers: List[Answer] = []
-            if wb_list := await WordBank.filter(
-                index_type=index_type.value,
-                index_id=index_id,
-                key=key,
-                match_type=MatchType.congruence.value,
-                require_to_me=to_me,
-            ):
-                for wb in wb_list:
-                    data = await WordBankData.get(id=wb.answer_id)
-                    answers.append(
-                        Answer(
-                            answer=data.answer,
-                            weight=wb.weight,
-                            last_cmd=wb.last_cmd,
-                            id=wb.id,
-                        )
-                    )
+        candidates = [
+            wb
+            for table in await WordBank._candidates(
+                index_type, index_id, key, to_me, unescaped_key
+            )
+            for wb in table.rows
+        ]
+        if not candidates:
+            return None
+        data = {
+            ans.id: ans.answer
+            for ans in await WordBankData.filter(
+                id__in={wb.answer_id for wb in candidates}
+            )
+        }
+        answers = [
+            Answer(
+                answer=data[wb.answer_id],
+                weight=wb.weight,
+                last_cmd=wb.last_cmd,
+                id=wb.id,
+            )
+            for wb in candidates
+            if wb.answer_id in data
+        ]
+        return (
+            WordEntry(key=key, answer=answers, require_to_me=to_me) if answers else None
+        )
 
-            if wb_list := await WordBank.filter(
-                index_type=index_type.value,
-                index_id=index_id,
-                match_type=MatchType.include.value,
-                require_to_me=to_me,
-            ):
-                for wb in wb_list:
-                    if wb.key in key:
-                        data = await WordBankData.get(id=wb.answer_id)
-                        answers.append(
-                            Answer(
-                                answer=data.answer,
-                                weight=wb.weight,
-                                last_cmd=wb.last_cmd,
-                                id=wb.id,
-                            )
-                        )
+    @staticmethod
+    async def random_answer(
+        index_type: IndexType,
+        index_id: str,
+        key: str,
+        to_me: bool = False,
+        unescaped_key: Optional[str] = None,
+    ) -> Optional[Answer]:
+        """
+        :说明: `random_answer`
+        > 匹配词库, 按权重随机选出一个答句, 只读取被选中的答句
 
-            if wb_list := await WordBank.filter(
-                index_type=index_type.value,
-                index_id=index_id,
-                match_type=MatchType.regex.value,
-                require_to_me=to_me,
-            ):
-                for wb in wb_list:
+        :参数:
+          * `index_type: IndexType`: 索引类型: IndexType.group 群聊, IndexType.private 私聊
+          * `index_id: str`: 索引ID: 群聊ID, 私聊ID
+          * `key: str`: 问句
+
+        :可选参数:
+          * `to_me: bool = False`: 是否需要@
+          * `unescaped_key: Optional[str] = None`: 已反转义的问句, 为空时由 `key` 反转义
+
+        :返回:
+          - `Optional[Answer]`: 如匹配到词条则返回选中的答句
+        """
+        tables = await WordBank._candidates(
+            index_type, index_id, key, to_me, unescaped_key
+        )
+        if not (wb := weighted_pick(tables)):
+            return None
+        if not (data := await WordBankData.get_or_none(id=wb.answer_id)):
+            return None
+        return Answer(
+            answer=data.answer, weight=wb.weight, last_cmd=wb.last_cmd, id=wb.id
+        )
+
+    @staticmethod
+    async def _candidates(
+        index_type: IndexType,
+        index_id: str,
+        key: str,
+        to_me: bool = False,
+        unescaped_key: Optional[str] = None,
+    ) -> List[WeightedRows]:
+        """
+        :说明: `_candidates`
+        > 在会话词库和全局词库中查找匹配的问句 (不读取答句)
+
+        :参数:
+          * `index_type: IndexType`: 索引类型
+          * `index_id: str`: 索引ID
+          * `key: str`: 问句
+
+        :可选参数:
+          * `to_me: bool = False`: 是否需要@
+          * `unescaped_key: Optional[str] = None`: 已反转义的问句, 为空时由 `key` 反转义
+
+        :返回:
+          - `List[WeightedRows]`: 匹配到的问句及其词条
+        """
+        await revision_log.poll()
+        cache_key = (index_type.value, str(index_id), key, to_me)
+        if (cached := match_cache.get(cache_key)) is not None:
+            return list(cached)
+        generation = match_cache.generation
+
+        index_types = [index_type]
+        if index_type != IndexType._global:
+            index_types.append(IndexType._global)
+        buckets: Dict[IndexType, IndexBucket] = {}
+        missing: List[IndexType] = []
+        for _index_type in index_types:
+            _key = bucket_key(_index_type, index_id, to_me)
+            if (bucket := match_index.get(_key)) is not None:
+                buckets[_index_type] = bucket
+            elif negative_filter.may_match(_key, key):
+                # 未加载且可能命中时才读取数据库
+                missing.append(_index_type)
+        if missing:
+            loaded = await WordBank._buckets(missing, index_id, to_me)
+            buckets.update(zip(missing, loaded))
+
+        # 会话词库在前, 全局词库在后
+        ordered = [buckets[t] for t in index_types if t in buckets]
+        all_types = [MatchType.congruence, MatchType.include, MatchType.regex]
+        policy = plugin_config.wordbank_match_policy
+        groups = [[b] for b in ordered] if policy == "session" else [ordered]
+        tiers = [[t] for t in all_types] if policy == "tier" else [all_types]
+
+        candidates: List[WeightedRows] = []
+        # 正则匹配被中断时结果不完整, 不写入缓存
+        complete = True
+        if unescaped_key is None:
+            unescaped_key = unescape(key)
+        for group in groups:
+            for tier in tiers:
+                # 同一组索引的候选正则一次交给子进程执行
+                regex: List[List[WeightedRows]] = []
+                if MatchType.regex in tier:
                     try:
-                        _wb_key = unescape(wb.key)
-                        _key = unescape(key)
-                        if bool(re.search(_wb_key, _key, re.S)):
-                            data = await WordBankData.get(id=wb.answer_id)
-                            answers.append(
-                                Answer(
-                                    answer=data.answer,
-                                    weight=wb.weight,
-                                    last_cmd=wb.last_cmd,
-                                    id=wb.id,
-                                )
-                            )
-                    except re.error:
-                        continue
-
-            we = WordEntry(key=key, answer=answers, require_to_me=to_me)
-            return we
-
-        _we = await _match(index_type=index_type)
-        _gl_we = await _match(index_type=IndexType._global)
-        _we.answer += _gl_we.answer
-        return _we if _we.answer else None
+                        regex = await WordBank._match_regex(group, unescaped_key)
+                    except RegexAborted:
+                        complete = False
+                        regex = [[] for _ in group]
+                for i, bucket in enumerate(group):
+                    for match_type in tier:
+                        candidates.extend(
+                            regex[i]
+                            if match_type == MatchType.regex
+                            else bucket.match(key, match_type)
+                        )
+                if candidates:
+                    # 较便宜的一层已有结果, 跳过之后的匹配
+                    break
+            if candidates:
+                break
+        if complete:
+            match_cache.put(cache_key, candidates, generation)
+        return candidates
+
+    @staticmethod
+    async def _match_regex(
+        buckets: List[IndexBucket], unescaped_key: str
+    ) -> List[List[WeightedRows]]:
+        """
+        :说明: `_match_regex`
+        > 在多个索引中查找匹配的正则词条, 全部候选正则只提交一次, 超时的词条会被停用
+
+        :参数:
+          * `buckets: List[IndexBucket]`: 索引
+          * `unescaped_key: str`: 已反转义的问句
+
+        :返回:
+          - `List[List[WeightedRows]]`: 与 `buckets` 一一对应的匹配结果
+
+        :异常:
+          - `RegexAborted`: 匹配被其他正则的超时中断
+        """
+        candidates = [bucket.regex_candidates(unescaped_key) for bucket in buckets]
+        found = iter(
+            await regex_sandbox.search_many(
+                [pattern for tables in candidates for _, pattern in tables],
+                unescaped_key,
+            )
+        )
+        result: List[List[WeightedRows]] = []
+        for tables in candidates:
+            matched: List[WeightedRows] = []
+            for table, _ in tables:
+                if (ok := next(found)) is None:
+                    await WordBank._block(table.rows, "正则匹配超时")
+                elif ok:
+                    matched.append(table)
+            result.append(matched)
+        return result
+
+    @staticmethod
+    async def _block(rows: Iterable[Entry], reason: str):
+        """
+        :说明: `_block`
+        > 停用词条并从内存索引中移除
+
+        :参数:
+          * `rows: Iterable[Entry]`: 词条
+          * `reason: str`: 停用原因
+        """
+        for wb in rows:
+            logger.warning(f"词条 {wb.id} ({wb.key}) 已被停用: {reason}")
+            await WordBank.filter(id=wb.id).update(
+                block=True, update_time=datetime.now()
+            )
+            await match_index.discard(
+                bucket_key(wb.index_type, wb.index_id, wb.require_to_me), [wb.id]
+            )
+            await revision_log.touch(wb.index_type, wb.index_id)
+
+    @staticmethod
+    async def build_negative_filter(chunk_size: int = 5000):
+        """
+        :说明: `build_negative_filter`
+        > 从数据库分页读取全部问句, 构建未加载索引的否定过滤器
+
+        :可选参数:
+          * `chunk_size: int = 5000`: 每页读取的词条数
+        """
+        builder = negative_filter.build(
+            await WordBank.filter(
+                match_type=MatchType.congruence.value, block=False
+            ).count()
+        )
+        last_id = 0
+        while page := (
+            await WordBank.filter(id__gt=last_id, block=False)
+            .order_by("id")
+            .limit(chunk_size)
+            .values_list(
+                "id", "index_type", "index_id", "require_to_me", "match_type", "key"
+            )
+        ):
+            for id, index_type, index_id, require_to_me, match_type, key in page:
+                builder.add(
+                    bucket_key(index_type, index_id, require_to_me), match_type, key
+                )
+            last_id = page[-1][0]
+        builder.finish()
+
+    @staticmethod
+    async def _buckets(
+        index_types: List[IndexType], index_id: str, require_to_me: bool
+    ) -> List[IndexBucket]:
+        """
+        :说明: `_buckets`
+        > 获取内存匹配索引, 未加载的索引用一次查询从数据库读取
+
+        一次读取会同时加载 `require_to_me` 为真和为假的两份索引.
+        全局词库不区分索引ID, 所有会话共用同一份
+
+        :参数:
+          * `index_types: List[IndexType]`: 索引类型列表
+          * `index_id: str`: 索引ID
+          * `require_to_me: bool`: 是否需要@
+
+        :返回:
+          - `List[IndexBucket]`: 与 `index_types` 一一对应的索引
+        """
+        keys = [bucket_key(t, index_id, require_to_me) for t in index_types]
+        buckets = [match_index.get(key) for key in keys]
+        if all(bucket is not None for bucket in buckets):
+            return buckets  # type: ignore
+
+        missing = [t for t, bucket in zip(index_types, buckets) if bucket is None]
+        load_keys = [
+            key
+            for t in missing
+            for to_me in (False, True)
+            if (key := bucket_key(t, index_id, to_me)) not in match_index
+        ]
+        versions = {key: match_index.version(key) for key in load_keys}
+        rows: Dict[BucketKey, List[Entry]] = {key: [] for key in load_keys}
+        query = Q()
+        if session := [t.value for t in missing if t != IndexType._global]:
+            query |= Q(index_type__in=session, index_id=str(index_id))
+        if IndexType._global in missing:
+            query |= Q(index_type=IndexType._global.value)
+        for values in await WordBank.filter(query, block=False).values_list(
+            *Entry.__slots__
+        ):
+            entry = Entry(*values)
+            key = bucket_key(entry.index_type, entry.index_id, entry.require_to_me)
+            if key in rows:
+                rows[key].append(entry)
+        loaded = {
+            key: await match_index.put(key, rows[key], versions[key])
+            for key in load_keys
+        }
+        return [
+            bucket if bucket is not None else loaded[key]
+            for key, bucket in zip(keys, buckets)
+        ]
 
     @staticmethod
     async def set(
@@ -193,24 +417,122 @@ class WordBank(Model):
 
         :返回:
           - `bool`: 是否添加成功
+
+        :Exceptions:
+          * `ValueError`: 权重超出范围, 或正则问句无法编译/回溯风险过高
         """
         if weight < 1 or weight > 10:
             raise ValueError("权重必须为 1~10 的整数")
-        ans = await WordBankData.create(answer=answer)
-        wb, created = await WordBank.get_or_create(
-            index_type=index_type.value,
-            index_id=index_id,
-            match_type=match_type.value,
-            key=key,
-            answer_id=ans.id,
-            require_to_me=require_to_me,
-            creator_id=creator_id,
-            last_ans=answer,
-            last_cmd=CmdType.add.value,
-            weight=weight,
-        )
+        if match_type == MatchType.regex:
+            validate_regex(key)
+        async with in_transaction(WordBank._meta.default_connection) as conn:
+            wb, created = await WordBank.get_or_create(
+                using_db=conn,
+                index_type=index_type.value,
+                index_id=index_id,
+                match_type=match_type.value,
+                key=key,
+                answer_id=await WordBankData.intern(answer, using_db=conn),
+                require_to_me=require_to_me,
+                creator_id=creator_id,
+                last_ans=answer,
+                last_cmd=CmdType.add.value,
+                weight=weight,
+            )
+        if created:
+            if match_type == MatchType.regex:
+                # 预先编译, 匹配时直接复用
+                regex_cache.get(wb.id, key)
+            await match_index.add(Entry.from_row(wb))
+            _key = bucket_key(index_type, index_id, require_to_me)
+            negative_filter.add(_key, match_type.value, key)
+            await revision_log.added(_key, match_type.value, [key])
         return wb.id, created
 
+    @staticmethod
+    async def bulk_set(
+        entries: Iterable[NewWordEntry],
+        chunk_size: int = 500,
+        validated: bool = False,
+    ) -> List[int]:
+        """
+        :说明: `bulk_set`
+        > 批量添加词条, 全部词条在同一个事务中分块写入, 任一词条有误时全部不添加
+
+        权重范围由 `NewWordEntry` 检查
+
+        :参数:
+          * `entries: Iterable[NewWordEntry]`: 词条, 可以是生成器
+
+        :可选参数:
+          * `chunk_size: int = 500`: 每次查询已有答句的词条数
+          * `validated: bool = False`: 正则问句已由调用方用 `validate_regex` 检查过
+
+        :返回:
+          - `List[int]`: 新增的问答ID, 与 `entries` 一一对应
+
+        :Exceptions:
+          * `ValueError`: 正则问句无法编译/回溯风险过高
+        """
+        created: List[int] = []
+        changed: Set[Tuple[int, str]] = set()
+        added: Dict[Tuple[BucketKey, int], List[str]] = {}
+        entries = iter(entries)
+        conn_name = WordBank._meta.default_connection
+        async with in_transaction(conn_name) as conn:
+            # bulk_create 不返回自增ID, 逐条写入由数据库分配ID, 已删除的ID不会被复用
+            while chunk := list(islice(entries, chunk_size)):
+                # 复用内容相同的答句, 只写入新的答句
+                hashes = {entry.answer: answer_hash(entry.answer) for entry in chunk}
+                answer_ids = dict(
+                    await WordBankData.filter(hash__in=set(hashes.values()))
+                    .using_db(conn)
+                    .values_list("hash", "id")
+                )
+                for entry in chunk:
+                    if not validated and entry.match_type == MatchType.regex:
+                        try:
+                            validate_regex(entry.key)
+                        except ValueError as e:
+                            raise ValueError(f"第 {len(created) + 1} 条词条: {e}") from None
+                    _hash = hashes[entry.answer]
+                    if _hash not in answer_ids:
+                        data = await WordBankData.create(
+                            answer=entry.answer, hash=_hash, using_db=conn
+                        )
+                        answer_ids[_hash] = data.id
+                    wb = await WordBank.create(
+                        index_type=entry.index_type.value,
+                        index_id=entry.index_id,
+                        match_type=entry.match_type.value,
+                        key=entry.key,
+                        answer_id=answer_ids[_hash],
+                        require_to_me=entry.require_to_me,
+                        creator_id=entry.creator_id,
+                        last_ans=entry.answer,
+                        last_cmd=CmdType.add.value,
+                        weight=entry.weight,
+                        using_db=conn,
+                    )
+                    created.append(wb.id)
+                    _key = bucket_key(
+                        entry.index_type, entry.index_id, entry.require_to_me
+                    )
+                    added.setdefault((_key, entry.match_type.value), []).append(
+                        entry.key
+                    )
+                    changed.add((entry.index_type.value, entry.index_id))
+
+            # 其他进程只需知道哪些索引有新增, 不逐条同步问句
+            await revision_log.bulk_added({_key for _key, _ in added}, using_db=conn)
+
+        for (_key, match_type), keys in added.items():
+            for key in keys:
+                negative_filter.add(_key, match_type, key)
+        for index_type, index_id in changed:
+            match_index.invalidate(index_type, index_id)
+        return created
+
     @staticmethod
     async def keys(index_type: IndexType, index_id: str) -> List[str]:
         """
@@ -233,6 +555,189 @@ class WordBank(Model):
             keys.append(wb.key)
         return keys
 
+    @staticmethod
+    async def iter_entries(
+        index_type: Optional[IndexType] = None,
+        index_id: Optional[str] = None,
+        chunk_size: int = 1000,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        :说明: `iter_entries`
+        > 按ID分页读取词条及答句, 每页是一次独立的短查询, 不会长时间占用读锁
+
+        被屏蔽的词条不会导出. 返回的字段与 `NewWordEntry` 一致, 可直接用于导入
+
+        :可选参数:
+          * `index_type: Optional[IndexType] = None`: 索引类型, 为 None 时读取全部词库
+          * `index_id: Optional[str] = None`: 索引ID, 为 None 时读取该类型下全部索引
+          * `chunk_size: int = 1000`: 每页读取的词条数
+
+        :返回:
+          - `AsyncIterator[List[Dict[str, Any]]]`: 每页的词条
+        """
+        query = Q(block=False)
+        if index_type is not None:
+            query &= Q(index_type=index_type.value)
+        if index_id is not None:
+            query &= Q(index_id=index_id)
+        last_id = 0
+        while page := (
+            await WordBank.filter(query, id__gt=last_id)
+            .order_by("id")
+            .limit(chunk_size)
+            .values(
+                "id",
+                "index_type",
+                "index_id",
+                "match_type",
+                "key",
+                "answer_id",
+                "require_to_me",
+                "weight",
+                "creator_id",
+            )
+        ):
+            answers = dict(
+                await WordBankData.filter(
+                    id__in={row["answer_id"] for row in page}
+                ).values_list("id", "answer")
+            )
+            last_id = page[-1]["id"]
+            yield [
+                {
+                    "index_type": row["index_type"],
+                    "index_id": row["index_id"],
+                    "match_type": row["match_type"],
+                    "key": row["key"],
+                    "answer": answers[row["answer_id"]],
+                    "require_to_me": row["require_to_me"],
+                    "weight": row["weight"],
+                    "creator_id": row["creator_id"],
+                }
+                for row in page
+                if row["answer_id"] in answers
+            ]
+
+    @staticmethod
+    async def _delete_rows(
+        query: Q, chunk_size: int = 500
+    ) -> List[Tuple[int, int, int, str, bool]]:
+        """
+        :说明: `_delete_rows`
+        > 删除符合条件的词条及其答句
+
+        先用一次查询取出词条ID, 再在同一个事务中按 `id__in` 分块删除,
+        语句数与词条数无关, 单条语句的参数数量也不会超出数据库限制.
+        答句在不再被任何词条引用时才会删除
+
+        :参数:
+          * `query: Q`: 筛选条件
+
+        :可选参数:
+          * `chunk_size: int = 500`: 每条语句删除的词条数
+
+        :返回:
+          - `List[Tuple[int, int, int, str, bool]]`: 已删除词条的
+                (ID, 答句ID, 索引类型, 索引ID, 是否需要@)
+        """
+        rows = await WordBank.filter(query).values_list(
+            "id", "answer_id", "index_type", "index_id", "require_to_me"
+        )
+        if not rows:
+            return []
+        async with in_transaction(WordBank._meta.default_connection) as conn:
+            it = iter(rows)
+            while chunk := list(islice(it, chunk_size)):
+                await WordBank.filter(id__in=[row[0] for row in chunk]).using_db(
+                    conn
+                ).delete()
+                await WordBank._collect_answers({row[1] for row in chunk}, conn)
+            for index_type, index_id in {(row[2], row[3]) for row in rows}:
+                await revision_log.touch(index_type, index_id, using_db=conn)
+        return rows
+
+    @staticmethod
+    async def _collect_answers(answer_ids: Set[int], using_db: BaseDBAsyncClient):
+        """
+        :说明: `_collect_answers`
+        > 删除不再被任何词条引用的答句, 引用计数即引用该答句的词条数
+
+        :参数:
+          * `answer_ids: Set[int]`: 可能失去引用的答句ID
+          * `using_db: BaseDBAsyncClient`: 在该连接 (事务) 中执行
+        """
+        if not answer_ids:
+            return
+        referenced = await (
+            WordBank.filter(answer_id__in=answer_ids)
+            .using_db(using_db)
+            .distinct()
+            .values_list("answer_id", flat=True)
+        )
+        if orphans := answer_ids.difference(referenced):
+            await WordBankData.filter(id__in=orphans).using_db(using_db).delete()
+
+    @staticmethod
+    async def _replace_answers(
+        rows: Iterable[Tuple[int, int, int, str]], answers: Dict[int, str]
+    ) -> List[int]:
+        """
+        :说明: `_replace_answers`
+        > 写时复制地修改答句: 词条改为引用新内容的答句, 其他引用原答句的词条不受影响
+
+        原答句记入 `last_ans`, 不再被引用时删除
+
+        :参数:
+          * `rows: Iterable[Tuple[int, int, int, str]]`: 词条 (ID, 答句ID, 索引类型, 索引ID)
+          * `answers: Dict[int, str]`: 词条ID -> 新答句
+
+        :返回:
+          - `List[int]`: 新答句ID
+        """
+        groups: Dict[Tuple[str, int], List[int]] = {}
+        changed: Set[Tuple[int, str]] = set()
+        for id, answer_id, index_type, index_id in rows:
+            groups.setdefault((answers[id], answer_id), []).append(id)
+            changed.add((index_type, index_id))
+        if not groups:
+            return []
+
+        interned: Dict[str, int] = {}
+        async with in_transaction(WordBank._meta.default_connection) as conn:
+            old = dict(
+                await WordBankData.filter(id__in={key[1] for key in groups})
+                .using_db(conn)
+                .values_list("id", "answer")
+            )
+            for (answer, answer_id), ids in groups.items():
+                if answer not in interned:
+                    interned[answer] = await WordBankData.intern(answer, using_db=conn)
+                await WordBank.filter(id__in=ids).using_db(conn).update(
+                    answer_id=interned[answer],
+                    last_ans=old.get(answer_id, ""),
+                    last_cmd=CmdType.update.value,
+                    update_time=datetime.now(),
+                )
+            await WordBank._collect_answers({key[1] for key in groups}, conn)
+            for index_type, index_id in changed:
+                await revision_log.touch(index_type, index_id, using_db=conn)
+
+        # 索引中的词条记录了答句ID, 需要重新加载
+        for index_type, index_id in changed:
+            match_index.invalidate(index_type, index_id)
+        return list(interned.values())
+
+    @staticmethod
+    async def _discard_rows(rows: Iterable[Tuple[int, int, int, str, bool]]):
+        """从内存索引中移除 `_delete_rows` 删除的词条"""
+        removed: Dict[BucketKey, List[int]] = {}
+        for id, _, index_type, index_id, require_to_me in rows:
+            removed.setdefault(
+                bucket_key(index_type, index_id, require_to_me), []
+            ).append(id)
+        for key, ids in removed.items():
+            await match_index.discard(key, ids)
+
     @staticmethod
     async def delete_by_key(
         index_type: IndexType,
@@ -259,46 +764,49 @@ class WordBank(Model):
         :返回:
           - `Tuple[List[int], bool]`: 已删除的答句ID列表, 是否删除成功
         """
-        match = await WordBank.filter(
-            index_type=index_type.value,
-            index_id=index_id,
-            match_type=match_type.value,
-            key=key,
-            require_to_me=require_to_me,
+        rows = await WordBank._delete_rows(
+            Q(
+                index_type=index_type.value,
+                index_id=index_id,
+                match_type=match_type.value,
+                key=key,
+                require_to_me=require_to_me,
+            )
         )
-        if not match:
+        if not rows:
             return [], False
-        ans_id_list = [ans.answer_id for ans in match]
-        for id in ans_id_list:
-            await WordBankData.filter(id=id).delete()
-
-        await WordBank.filter(
-            index_type=index_type.value,
-            index_id=index_id,
-            match_type=match_type.value,
-            key=key,
-            require_to_me=require_to_me,
-        ).delete()
-
-        return ans_id_list, True
+        await WordBank._discard_rows(rows)
+        return [row[1] for row in rows], True
 
     @staticmethod
     async def delete_by_answer_id(
         answer_id_list: List[int],
+        index_type: Optional[IndexType] = None,
+        index_id: Optional[str] = None,
     ) -> Tuple[List[int], bool]:
         """
         :说明: `delete_by_answer_id`
         > 删除指定答句ID对应的词条
 
+        相同内容的答句只保存一份, 可能被多个索引的词条引用.
+        不指定索引时会删除所有会话中引用这些答句的词条
+
         :参数:
           * `answer_id: Union[int, List[int]]`: 答句ID列表
 
+        :可选参数:
+          * `index_type: Optional[IndexType] = None`: 只删除该索引类型下的词条
+          * `index_id: Optional[str] = None`: 只删除该索引ID下的词条
+
         :返回:
           - `Tuple[List[int], bool]`: 已删除的答句ID列表, 是否删除成功
         """
-        for id in answer_id_list:
-            await WordBank.filter(answer_id=id).delete()
-            await WordBankData.filter(id=id).delete()
+        query = Q(answer_id__in=answer_id_list)
+        if index_type is not None:
+            query &= Q(index_type=index_type.value)
+        if index_id is not None:
+            query &= Q(index_id=index_id)
+        await WordBank._discard_rows(await WordBank._delete_rows(query))
         return answer_id_list, True
 
     @staticmethod
@@ -327,17 +835,17 @@ class WordBank(Model):
         :返回:
           - `bool: 是否删除成功
         """
-        key = await WordBank.filter(id=key_id).values()
-        for ans in key:
-            ans_id = ans["answer_id"]
-            await WordBankData.filter(id=ans_id).delete()
-        await WordBank.filter(
-            index_type=index_type.value,
-            index_id=index_id,
-            id=key_id,
-            match_type=match_type.value,
-            require_to_me=require_to_me,
-        ).delete()
+        await WordBank._discard_rows(
+            await WordBank._delete_rows(
+                Q(
+                    index_type=index_type.value,
+                    index_id=index_id,
+                    id=key_id,
+                    match_type=match_type.value,
+                    require_to_me=require_to_me,
+                )
+            )
+        )
         return True
 
     @staticmethod
@@ -364,24 +872,19 @@ class WordBank(Model):
         """
 
         if index_id is None and index_type is None and match_type is None:
-            await WordBank.all().delete()
-            await WordBankData.all().delete()
+            async with in_transaction(WordBank._meta.default_connection) as conn:
+                await WordBank.all().using_db(conn).delete()
+                await WordBankData.all().using_db(conn).delete()
+                await revision_log.touch(using_db=conn)
+            match_index.invalidate()
             return True
 
         if index_id and index_type:
-            match = await WordBank.filter(
-                index_id=index_id,
-                index_type=index_type.value,
-                match_type=match_type.value if match_type else None,
-            )
-            ans_id_list = [ans.answer_id for ans in match]
-            for id in ans_id_list:
-                await WordBankData.filter(id=id).delete()
-
-            await WordBank.filter(
-                index_id=index_id,
-                index_type=index_type.value,
-            ).delete()
+            query = Q(index_id=index_id, index_type=index_type.value)
+            if match_type is not None:
+                query &= Q(match_type=match_type.value)
+            await WordBank._delete_rows(query)
+            match_index.invalidate(index_type.value, index_id)
 
             return True
 
@@ -446,6 +949,16 @@ class WordBank(Model):
             update_time=datetime.now(),
             require_to_me=update_require_to_me,
         )
+        regex_cache.discard(wb.id for wb in match)
+        match_index.invalidate(index_type.value, index_id)
+        match_index.invalidate(update_index_type.value, update_index_id)
+        _key = bucket_key(update_index_type, update_index_id, update_require_to_me)
+        for wb in match:
+            negative_filter.add(_key, update_match_type.value, wb.key)
+        await revision_log.touch(index_type.value, index_id)
+        await revision_log.added(
+            _key, update_match_type.value, {wb.key for wb in match}
+        )
 
         return True
 
@@ -508,6 +1021,16 @@ class WordBank(Model):
             update_time=datetime.now(),
             require_to_me=update_require_to_me,
         )
+        regex_cache.discard(wb.id for wb in match)
+        match_index.invalidate(index_type.value, index_id)
+        match_index.invalidate(update_index_type.value, update_index_id)
+        _key = bucket_key(update_index_type, update_index_id, update_require_to_me)
+        for wb in match:
+            negative_filter.add(_key, update_match_type.value, wb.key)
+        await revision_log.touch(index_type.value, index_id)
+        await revision_log.added(
+            _key, update_match_type.value, {wb.key for wb in match}
+        )
 
         return True
 
@@ -515,31 +1038,39 @@ class WordBank(Model):
     async def update_answer(
         answer_id_list: List[int],
         update_answer: str,
+        index_type: Optional[IndexType] = None,
+        index_id: Optional[str] = None,
     ) -> Tuple[List[int], bool]:
         """
         :说明: `update_answer`
         > 修改指定答句ID对应的答句
 
+        相同内容的答句只保存一份, 可能被多个索引的词条引用. 修改时只有被修改的词条
+        改为引用新答句, 可以指定索引以免影响其他会话
+
         :参数:
           * `answer_id: Union[int, List[int]]`: 答句ID列表
           * `update_answer: str`: 更新答句
 
+        :可选参数:
+          * `index_type: Optional[IndexType] = None`: 只修改该索引类型下的词条
+          * `index_id: Optional[str] = None`: 只修改该索引ID下的词条
+
         :返回:
           - `Tuple[List[int], bool]`: 已修改的答句ID列表, 是否修改成功
         """
-        try:
-            for id in answer_id_list:
-                for origin_ans in await WordBank.filter(answer_id=id).values():
-                    origin_answer: str = origin_ans["answer"]
-                await WordBankData.filter(id=id).update(answer=update_answer)
-                await WordBank.filter(answer_id=id).update(
-                    update_time=datetime.now(),
-                    last_key=origin_answer,
-                    last_cmd=CmdType.update,
-                )
-            return answer_id_list, True
-        except UnboundLocalError:
+        query = Q(answer_id__in=answer_id_list)
+        if index_type is not None:
+            query &= Q(index_type=index_type.value)
+        if index_id is not None:
+            query &= Q(index_id=index_id)
+        rows = await WordBank.filter(query).values_list(
+            "id", "answer_id", "index_type", "index_id"
+        )
+        if not rows:
             return [], False
+        await WordBank._replace_answers(rows, {row[0]: update_answer for row in rows})
+        return sorted({row[1] for row in rows}), True
 
     @staticmethod
     async def key_return(index_type: IndexType, index_id: str, key: str) -> List[int]:
@@ -607,18 +1138,13 @@ class WordBank(Model):
     async def last_ans_return(
         index_type: IndexType, index_id: str, key: str
     ) -> List[int]:
-        """回退最近操作"""
-        ids: List[int] = []
-        wb_list = await WordBank.filter(
+        """回退最近操作: 答句与 `last_ans` 互换, 返回新答句ID"""
+        rows = await WordBank.filter(
             index_type=index_type.value, index_id=index_id, key=key
-        ).all()
-        for wb in wb_list:
-            await WordBankData.filter(id=wb.answer_id).update(answer=wb["last_key"])  # type: ignore
-            await WordBank.filter(id=wb.id).update(
-                update_time=datetime.now(), last_key=wb.key, last_cmd=2
-            )
-            ids.append(wb.answer_id)
-        return ids
+        ).values_list("id", "answer_id", "index_type", "index_id", "last_ans")
+        return await WordBank._replace_answers(
+            [row[:4] for row in rows], {row[0]: row[4] for row in rows}
+        )
 
     @staticmethod
     async def keys_id_return(id: int) -> List[str]:
@@ -1,20 +1,50 @@
+from typing import List, Optional
+from hashlib import sha256
+
 from tortoise import fields
 from tortoise.models import Model
-from typing import List
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+
+def answer_hash(answer: str) -> str:
+    """答句内容的哈希, 相同的答句只保存一份"""
+    return sha256(answer.encode()).hexdigest()
 
 
 class WordBankData(Model):
     id = fields.IntField(pk=True, generated=True)
     answer = fields.TextField()
+    hash = fields.CharField(max_length=64, null=True)
+    """答句内容的哈希, 唯一索引由迁移创建"""
 
     class Meta:
         table = "wordbank3_data"
         table_description = "wordbank3 答句数据库"
 
+    @staticmethod
+    async def intern(answer: str, using_db: Optional[BaseDBAsyncClient] = None) -> int:
+        """
+        :说明: `intern`
+        > 获取答句ID, 相同内容的答句已存在时直接复用, 否则新建
+
+        :参数:
+          * `answer: str`: 答句
+
+        :可选参数:
+          * `using_db: Optional[BaseDBAsyncClient] = None`: 在该连接 (事务) 中执行
+
+        :返回:
+          - `int`: 答句ID
+        """
+        data, _ = await WordBankData.get_or_create(
+            defaults={"answer": answer}, using_db=using_db, hash=answer_hash(answer)
+        )
+        return data.id
+
     @staticmethod
     async def ans_return(ans: str) -> List[int]:
         id_list = []
-        wb_list = await WordBankData.filter(answer=ans).values()
+        wb_list = await WordBankData.filter(hash=answer_hash(ans)).values()
         for wb in wb_list:
             id_list.append(wb["id"])
         return id_list
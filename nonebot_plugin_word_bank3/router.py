@@ -0,0 +1,117 @@
+import re
+from typing import Any, List, Tuple, Callable, Iterable, Optional, NamedTuple
+
+from nonebot.typing import T_State, T_Handler
+from nonebot.matcher import Matcher
+from nonebot.dependencies import Dependent
+from nonebot.permission import Permission
+from nonebot.consts import REGEX_DICT, REGEX_STR, REGEX_GROUP, REGEX_MATCHED
+from nonebot.adapters.onebot.v11 import Bot, MessageEvent
+
+from .utils import NORMALIZED_MESSAGE, NormalizedMessage, normalize_message
+
+ROUTE_KEY = "_wordbank_route"
+"""`T_State` 中保存命中的 `Route` 的键"""
+
+
+class Route(NamedTuple):
+    prefixes: Tuple[str, ...]
+    """消息 (去掉开头空白后) 须以其中之一开头"""
+    regex: "re.Pattern[str]"
+    permission: Permission
+    handler: Optional[Dependent[Any]]
+    """为空时只拦截消息, 不做处理"""
+
+
+class Router:
+    """
+    :说明: `Router`
+    > 词库命令分发, 只注册一个响应器
+
+    先用前缀快速排除普通消息, 再按注册顺序检查正则和权限,
+    第一个通过的命令会被执行. 正则结果与 `on_regex` 一样写入 `T_State`,
+    处理函数中可以继续使用 `RegexGroup()` 等参数
+    """
+
+    def __init__(self):
+        self.routes: List[Route] = []
+        self.prefixes: Tuple[str, ...] = ()
+
+    def add(
+        self,
+        prefixes: Iterable[str],
+        regex: str,
+        permission: Permission,
+        handler: Optional[T_Handler] = None,
+        flags: int = re.S,
+    ):
+        """
+        :说明: `add`
+        > 注册命令
+
+        :参数:
+          * `prefixes: Iterable[str]`: 命令可能的开头
+          * `regex: str`: 命令正则
+          * `permission: Permission`: 权限
+
+        :可选参数:
+          * `handler: Optional[T_Handler] = None`: 处理函数, 为空时只拦截消息
+          * `flags: int = re.S`: 正则标志
+        """
+        prefixes = tuple(prefixes)
+        self.routes.append(
+            Route(
+                prefixes=prefixes,
+                regex=re.compile(regex, flags),
+                permission=permission,
+                handler=handler
+                and Dependent[Any].parse(
+                    call=handler, allow_types=Matcher.HANDLER_PARAM_TYPES
+                ),
+            )
+        )
+        self.prefixes += tuple(p for p in prefixes if p not in self.prefixes)
+
+    def route(
+        self,
+        prefixes: Iterable[str],
+        regex: str,
+        permission: Permission,
+        flags: int = re.S,
+    ) -> Callable[[T_Handler], T_Handler]:
+        """以装饰器的形式注册命令, 参数同 `add`"""
+
+        def decorator(func: T_Handler) -> T_Handler:
+            self.add(prefixes, regex, permission, func, flags)
+            return func
+
+        return decorator
+
+    async def rule(self, bot: Bot, event: MessageEvent, state: T_State) -> bool:
+        message: NormalizedMessage = state.get(NORMALIZED_MESSAGE) or normalize_message(
+            event
+        )
+        head = message.text.lstrip()
+        if not head.startswith(self.prefixes):
+            return False
+        for route in self.routes:
+            if not head.startswith(route.prefixes):
+                continue
+            if not (matched := route.regex.search(message.text)):
+                continue
+            if not await route.permission(bot, event):
+                continue
+            state[ROUTE_KEY] = route
+            state[REGEX_MATCHED] = matched.group()
+            state[REGEX_STR] = matched.group()
+            state[REGEX_GROUP] = matched.groups()
+            state[REGEX_DICT] = matched.groupdict()
+            return True
+        return False
+
+    async def handle(
+        self, matcher: Matcher, bot: Bot, event: MessageEvent, state: T_State
+    ):
+        route: Route = state[ROUTE_KEY]
+        if route.handler is not None:
+            await route.handler(matcher=matcher, bot=bot, event=event, state=state)
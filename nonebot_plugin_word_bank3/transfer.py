@@ -0,0 +1,197 @@
+import csv
+import json
+from typing import Any, Dict, List, Tuple, Iterator, Iterable, Optional, AsyncIterator
+from pathlib import Path
+from itertools import islice
+
+from pydantic import ValidationError
+
+from .utils import parse_key_flags
+from .models.word_bank import WordBank
+from .models.regex_cache import validate_regex
+from .models.typing_models import IndexType, MatchType, NewWordEntry
+
+import_dir = Path("data/wordbank/import").absolute()
+import_dir.mkdir(parents=True, exist_ok=True)
+export_dir = Path("data/wordbank/export").absolute()
+export_dir.mkdir(parents=True, exist_ok=True)
+
+Record = Tuple[int, Optional[Dict[str, Any]]]
+"""(行号, 记录), 无法解析的行记录为 None"""
+
+
+class ImportProgress:
+    """导入进度"""
+
+    def __init__(self):
+        self.imported = 0
+        """已导入的词条数"""
+        self.skipped = 0
+        """跳过的无效词条数"""
+        self.errors: List[str] = []
+        """前几条无效词条的原因"""
+
+    def skip(self, line: int, reason: str):
+        self.skipped += 1
+        if len(self.errors) < 5:
+            self.errors.append(f"第 {line} 行: {reason}")
+
+
+def resolve_path(name: str, directory: Path) -> Path:
+    """相对路径以 `directory` 为起点"""
+    path = Path(name).expanduser()
+    return path if path.is_absolute() else directory / path
+
+
+def read_records(path: Path) -> Iterator[Record]:
+    """
+    :说明: `read_records`
+    > 逐行读取 JSONL 或 CSV (首行为表头) 文件, 不会一次读入整个文件
+
+    :参数:
+      * `path: Path`: 文件路径, 后缀为 `.csv` 时按 CSV 读取, 否则按 JSONL 读取
+
+    :返回:
+      - `Iterator[Record]`: 行号及记录
+    """
+    with path.open(encoding="utf-8-sig", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except json.JSONDecodeError:
+                record = None
+            yield line, record if isinstance(record, dict) else None
+
+
+def parse_records(
+    records: Iterable[Record],
+    index_type: IndexType,
+    index_id: str,
+    creator_id: str,
+    progress: ImportProgress,
+) -> Iterator[NewWordEntry]:
+    """
+    :说明: `parse_records`
+    > 把记录转换为词条, 无效的记录计入 `progress` 后跳过
+
+    记录需要 `key` 和 `answer`, 其余字段可选. 没有 `match_type` 时按
+    问句开头的 `qg`/`zz`/`mh`/`@` 标记解析; 没有 `index_type` 时添加到当前会话
+
+    :参数:
+      * `records: Iterable[Record]`: 记录
+      * `index_type: IndexType`: 默认索引类型
+      * `index_id: str`: 默认索引ID
+      * `creator_id: str`: 默认创建人ID
+      * `progress: ImportProgress`: 导入进度
+    """
+    for line, record in records:
+        if record is None:
+            progress.skip(line, "无法解析")
+            continue
+        if not record.get("key") or not record.get("answer"):
+            progress.skip(line, "缺少问句或答句")
+            continue
+        fields = {k: v for k, v in record.items() if v not in ("", None)}
+        for name in ("index_type", "match_type"):
+            # CSV 中的值都是字符串
+            if isinstance(value := fields.get(name), str) and value.isdigit():
+                fields[name] = int(value)
+        if "match_type" not in fields:
+            flags = parse_key_flags(str(fields["key"]))
+            fields["key"] = flags.key
+            fields["match_type"] = flags.match_type
+            if flags.is_global:
+                fields.setdefault("index_type", IndexType._global)
+            if flags.require_to_me:
+                fields["require_to_me"] = True
+        fields.setdefault("index_type", index_type)
+        fields.setdefault("index_id", index_id)
+        fields.setdefault("creator_id", creator_id)
+        try:
+            entry = NewWordEntry.parse_obj(fields)
+            if entry.match_type == MatchType.regex:
+                validate_regex(entry.key)
+        except ValidationError as e:
+            error = e.errors()[0]
+            if error["type"] == "value_error":
+                # NewWordEntry 的检查
+                progress.skip(line, error["msg"])
+            else:
+                progress.skip(line, f"字段有误 ({error['loc'][0]})")
+            continue
+        except ValueError as e:
+            progress.skip(line, str(e))
+            continue
+        yield entry
+
+
+async def import_file(
+    path: Path,
+    index_type: IndexType,
+    index_id: str,
+    creator_id: str,
+    progress: ImportProgress,
+    batch_size: int = 2000,
+) -> AsyncIterator[ImportProgress]:
+    """
+    :说明: `import_file`
+    > 流式导入词库文件, 每写入一批词条返回一次进度
+
+    每批在独立的事务中写入, 内存占用与文件大小无关
+
+    :参数:
+      * `path: Path`: 文件路径
+      * `index_type: IndexType`: 默认索引类型
+      * `index_id: str`: 默认索引ID
+      * `creator_id: str`: 默认创建人ID
+      * `progress: ImportProgress`: 导入进度, 导入结束后可从中读取结果
+
+    :可选参数:
+      * `batch_size: int = 2000`: 每批写入的词条数
+    """
+    entries = parse_records(
+        read_records(path), index_type, index_id, creator_id, progress
+    )
+    while batch := list(islice(entries, batch_size)):
+        progress.imported += len(await WordBank.bulk_set(batch, validated=True))
+        yield progress
+
+
+async def export_file(
+    path: Path,
+    index_type: Optional[IndexType] = None,
+    index_id: Optional[str] = None,
+    chunk_size: int = 1000,
+) -> AsyncIterator[int]:
+    """
+    :说明: `export_file`
+    > 分页导出词库为 JSONL, 每写入一页返回一次已导出的词条数
+
+    先写入同目录下的 `.part` 临时文件, 全部写完后再替换目标文件
+
+    :参数:
+      * `path: Path`: 文件路径
+
+    :可选参数:
+      * `index_type: Optional[IndexType] = None`: 索引类型, 为 None 时导出全部词库
+      * `index_id: Optional[str] = None`: 索引ID, 为 None 时导出该类型下全部索引
+      * `chunk_size: int = 1000`: 每页读取的词条数
+    """
+    exported = 0
+    part = path.with_name(path.name + ".part")
+    try:
+        with part.open("w", encoding="utf-8") as f:
+            async for page in WordBank.iter_entries(index_type, index_id, chunk_size):
+                f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in page)
+                exported += len(page)
+                yield exported
+        part.replace(path)
+    finally:
+        part.unlink(missing_ok=True)
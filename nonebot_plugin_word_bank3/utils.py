@@ -1,12 +1,13 @@
 import re
-from typing import Optional
+from typing import Tuple, Iterable, Optional, NamedTuple
 from pathlib import Path
 
 import httpx
 from nonebot.log import logger
+from nonebot.adapters.onebot.v11.utils import unescape
 from nonebot.adapters.onebot.v11 import Message, MessageEvent, GroupMessageEvent
 
-from .models.typing_models import IndexType
+from .models.typing_models import IndexType, MatchType
 
 
 def regex_match(regex: str, text: str) -> bool:
@@ -30,6 +31,94 @@ def get_index_type(event: MessageEvent) -> IndexType:
         return IndexType.private
 
 
+NORMALIZED_MESSAGE = "_wordbank_message"
+"""`T_State` 中保存 `NormalizedMessage` 的键"""
+
+
+class NormalizedMessage(NamedTuple):
+    text: str
+    """消息 (CQ 码已转义), 用作问句"""
+    unescaped: str
+    """已反转义的消息, 用于正则匹配"""
+    to_me: bool
+    """是否@ (私聊总是为假)"""
+
+
+def strip_nickname(text: str, nicknames: Iterable[str]) -> Tuple[str, bool]:
+    """
+    :说明: `strip_nickname`
+    > 去掉开头的昵称
+
+    :参数:
+      * `text: str`: 文本
+      * `nicknames: Iterable[str]`: 昵称
+
+    :返回:
+      - `Tuple[str, bool]`: 去掉昵称后的文本, 是否以昵称开头
+    """
+    for name in nicknames:
+        if name and text.startswith(name):
+            return text[len(name) :], True
+    return text, False
+
+
+def normalize_message(event: MessageEvent) -> NormalizedMessage:
+    """
+    :说明: `normalize_message`
+    > 处理消息, 每个事件只需执行一次
+
+    :参数:
+      * `event: MessageEvent`: 消息事件
+
+    :返回:
+      - `NormalizedMessage`: 处理后的消息
+    """
+    text = str(event.get_message())
+    return NormalizedMessage(
+        text=text,
+        unescaped=unescape(text),
+        to_me=isinstance(event, GroupMessageEvent) and event.is_tome(),
+    )
+
+
+class KeyFlags(NamedTuple):
+    key: str
+    """去掉标记后的问句"""
+    is_global: bool
+    match_type: MatchType
+    require_to_me: bool
+
+
+def parse_key_flags(key: str) -> KeyFlags:
+    """
+    :说明: `parse_key_flags`
+    > 解析问句开头的标记: `qg` 全局, `zz` 正则, `mh` 模糊, `@` 需要@, 可以组合使用
+
+    :参数:
+      * `key: str`: 问句
+
+    :返回:
+      - `KeyFlags`: 去掉标记后的问句及标记
+    """
+    is_global = require_to_me = False
+    match_type = MatchType.congruence
+    while True:
+        if key.startswith("@"):
+            require_to_me = True
+            key = key[1:]
+            continue
+        if key.startswith("qg"):
+            is_global = True
+        elif key.startswith("zz"):
+            match_type = MatchType.regex
+        elif key.startswith("mh"):
+            match_type = MatchType.include
+        else:
+            break
+        key = key[2:]
+    return KeyFlags(key, is_global, match_type, require_to_me)
+
+
 def save_img(img: bytes, filepath: Path):
     with filepath.open("wb") as f:
         f.write(img)
@@ -442,3 +442,1254 @@ async def test_word_bank_clear_all(app: App, db):
 
         # 清空所有数据
         assert await WordBank.clear()
+
+
+@pytest.mark.asyncio
+async def test_match_index_sync(app: App, db):
+    """测试内存索引与写操作同步"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        # 先查询一次, 使索引被加载
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="hello_sync_test"
+        )
+
+        # 添加后应能立即匹配
+        _, res = await WordBank.set(
+            index_type=IndexType.group,
+            index_id=1,
+            match_type=MatchType.congruence,
+            key="hello_sync_test",
+            answer="world_sync_test",
+            creator_id=1,
+        )
+        assert res
+        res = await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="hello_sync_test"
+        )
+        assert res and len(res.answer) == 1
+
+        # 迁移后原索引不再匹配, 新索引可以匹配
+        assert await WordBank.update_by_key(
+            index_type=IndexType.group,
+            index_id=1,
+            key="hello_sync_test",
+            update_index_id=2,
+        )
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="hello_sync_test"
+        )
+        assert await WordBank.match(
+            index_type=IndexType.group, index_id=2, key="hello_sync_test"
+        )
+
+        # 删除后不再匹配
+        _, res = await WordBank.delete_by_key(
+            index_type=IndexType.group, index_id=2, key="hello_sync_test"
+        )
+        assert res
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=2, key="hello_sync_test"
+        )
+
+
+@pytest.mark.asyncio
+async def test_word_bank_include_multi_match(app: App, db):
+    """测试多个模糊匹配词条同时命中"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        for key in ["早上", "上好", "早上好", "晚上"]:
+            _, res = await WordBank.set(
+                index_type=IndexType.group,
+                index_id=1,
+                match_type=MatchType.include,
+                key=key,
+                answer=f"answer_{key}",
+                creator_id=1,
+            )
+            assert res
+
+        res = await WordBank.match(index_type=IndexType.group, index_id=1, key="大家早上好呀")
+        assert res
+        assert sorted(ans.answer for ans in res.answer) == [
+            "answer_上好",
+            "answer_早上",
+            "answer_早上好",
+        ]
+
+        _, res = await WordBank.delete_by_key(
+            index_type=IndexType.group,
+            index_id=1,
+            key="早上",
+            match_type=MatchType.include,
+        )
+        assert res
+        res = await WordBank.match(index_type=IndexType.group, index_id=1, key="大家早上好呀")
+        assert res and len(res.answer) == 2
+
+
+@pytest.mark.asyncio
+async def test_regex_cache(app: App, db):
+    """测试已编译正则缓存"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.regex_cache import regex_cache
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        # 旧版本中添加的无法编译的正则
+        ans = await WordBankData.create(answer="regex_cache_test")
+        await WordBank.create(
+            index_type=IndexType.group.value,
+            index_id="1",
+            match_type=MatchType.regex.value,
+            key="([",
+            answer_id=ans.id,
+            creator_id="1",
+            last_ans="",
+        )
+        _, res = await WordBank.set(
+            index_type=IndexType.group,
+            index_id=1,
+            match_type=MatchType.regex,
+            key="^来点(.*)图$",
+            answer="regex_cache_test",
+            creator_id=1,
+        )
+        assert res
+
+        # 消息各不相同, 避开匹配结果缓存
+        for key in ("来点色图", "来点猫图", "来点狗图"):
+            res = await WordBank.match(index_type=IndexType.group, index_id=1, key=key)
+            assert res and len(res.answer) == 1
+
+        # 两条正则 (含无法编译的) 各编译一次, 之后均命中缓存
+        info = regex_cache.cache_info()
+        assert info.misses == 2
+        assert info.hits == 5
+
+
+@pytest.mark.asyncio
+async def test_regex_prefilter(app: App, db):
+    """测试正则字面量预筛选"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.regex_cache import (
+        regex_cache,
+        required_literal,
+    )
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    assert required_literal("^来点(.*)图$") == "来点"
+    assert required_literal("(?:foo)?bar") == "bar"
+    assert required_literal("ab|cd") == ""
+    assert required_literal("(?i)hello") == ""
+
+    async with app.test_server():
+        _, res = await WordBank.set(
+            index_type=IndexType.group,
+            index_id=1,
+            match_type=MatchType.regex,
+            key="^来点(.*)图$",
+            answer="regex_prefilter_test",
+            creator_id=1,
+        )
+        assert res
+
+        # 消息中不含 "来点", 不执行正则
+        info = regex_cache.cache_info()
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="来张色图"
+        )
+        assert regex_cache.cache_info() == info
+
+        assert await WordBank.match(index_type=IndexType.group, index_id=1, key="来点色图")
+        assert regex_cache.cache_info().hits == info.hits + 1
+
+
+@pytest.mark.asyncio
+async def test_word_bank_random_answer(app: App, db):
+    """测试按权重随机选出答句"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import (
+        Answer,
+        IndexType,
+        MatchType,
+    )
+
+    async with app.test_server():
+        for answer, weight in [("random_a", 1), ("random_b", 10)]:
+            _, res = await WordBank.set(
+                index_type=IndexType.group,
+                index_id=1,
+                match_type=MatchType.congruence,
+                key="random_test",
+                answer=answer,
+                creator_id=1,
+                weight=weight,
+            )
+            assert res
+
+        res = await WordBank.random_answer(
+            index_type=IndexType.group, index_id=1, key="random_test"
+        )
+        assert isinstance(res, Answer)
+        assert res.answer in ("random_a", "random_b")
+
+        assert not await WordBank.random_answer(
+            index_type=IndexType.group, index_id=1, key="wtf"
+        )
+
+
+@pytest.mark.asyncio
+async def test_migration(app: App, db):
+    """测试数据库迁移"""
+    from tortoise import Tortoise
+
+    from nonebot_plugin_word_bank3.models.migration import (
+        MIGRATIONS,
+        WordBankVersion,
+        migrate,
+    )
+
+    async with app.test_server():
+        latest = await WordBankVersion.all().order_by("-version").first()
+        assert latest and latest.version == max(MIGRATIONS)
+
+        conn = Tortoise.get_connection("default")
+        _, rows = await conn.execute_query("PRAGMA index_list(wordbank3)")
+        indexes = {row["name"] for row in rows}
+        assert {"idx_wordbank3_match", "idx_wordbank3_answer_id"} <= indexes
+
+        # 重复执行不会再次应用
+        await migrate()
+        assert await WordBankVersion.all().count() == len(MIGRATIONS)
+
+
+@pytest.mark.asyncio
+async def test_negative_filter(app: App, db):
+    """测试未加载索引的否定过滤"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import bucket_key, match_index
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        _, res = await WordBank.set(
+            index_type=IndexType.group,
+            index_id=1,
+            match_type=MatchType.congruence,
+            key="hello_negative_test",
+            answer="world_negative_test",
+            creator_id=1,
+        )
+        assert res
+        await WordBank.build_negative_filter()
+        match_index.invalidate()
+        key = bucket_key(IndexType.group, 1)
+
+        # 不可能命中时不加载索引
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="wtf"
+        )
+        assert match_index.get(key) is None
+
+        assert await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="hello_negative_test"
+        )
+        assert match_index.get(key) is not None
+
+
+@pytest.mark.asyncio
+async def test_negative_filter_rebuild(app: App, db):
+    """测试否定过滤器容量用尽后在后台重建"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import bucket_key
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, NewWordEntry
+
+    async with app.test_server():
+        await WordBank.build_negative_filter()
+        assert negative_filter._bloom and negative_filter._bloom.capacity == 1024
+
+        await WordBank.bulk_set(
+            NewWordEntry(
+                index_type=IndexType.group,
+                index_id="1",
+                key=f"问{i}",
+                answer="答",
+                creator_id="1",
+            )
+            for i in range(1100)
+        )
+        # 重建期间不做否定判断
+        assert negative_filter._task is not None
+        assert negative_filter.may_match(bucket_key(IndexType.group, "1"), "wtf")
+        await negative_filter._task
+
+        bloom = negative_filter._bloom
+        assert bloom and bloom.capacity > 1100 * 2 and bloom.count >= 1100
+        key = bucket_key(IndexType.group, "1")
+        assert not negative_filter.may_match(key, "wtf")
+        assert all(negative_filter.may_match(key, f"问{i}") for i in range(1100))
+        assert await WordBank.match(IndexType.group, "1", "问1099")
+
+
+@pytest.mark.asyncio
+async def test_regex_timeout_block(app: App, db):
+    """测试正则匹配超时后停用词条"""
+    import time
+
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        # 旧版本中添加的未经检查的正则
+        ans = await WordBankData.create(answer="regex_timeout_test")
+        wb = await WordBank.create(
+            index_type=IndexType.group.value,
+            index_id="1",
+            match_type=MatchType.regex.value,
+            key="(a+)+$",
+            answer_id=ans.id,
+            creator_id="1",
+            last_ans="",
+        )
+        id = wb.id
+        await WordBank.build_negative_filter()
+
+        start = time.monotonic()
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="a" * 40 + "b"
+        )
+        assert time.monotonic() - start < 5
+        assert (await WordBank.get(id=id)).block
+
+        # 已停用的词条不再参与匹配
+        assert not await WordBank.match(
+            index_type=IndexType.group, index_id=1, key="aaa"
+        )
+
+
+@pytest.mark.asyncio
+async def test_regex_sandbox_batch(app: App):
+    """测试一条消息的候选正则一次提交"""
+    import re
+
+    from nonebot_plugin_word_bank3.models import regex_sandbox as sandbox
+
+    patterns = [re.compile(p, re.S) for p in ("^a", "(a+)+$", "b$", "^x")]
+    async with app.test_server():
+        assert await sandbox.regex_sandbox.search_many([], "a") == []
+        assert await sandbox.regex_sandbox.search_many(patterns, "a" * 40 + "b") == [
+            True,
+            None,
+            True,
+            False,
+        ]
+        assert await sandbox.regex_sandbox.search_many(patterns[2:], "xb") == [
+            True,
+            True,
+        ]
+
+    # 子进程中缓存已编译的正则
+    items = [(p.pattern, p.flags) for p in patterns[2:]]
+    assert sandbox._search_many(items, "xb") == [True, True]
+    assert all(item in sandbox._compiled for item in items)
+    # 子进程记录每条正则的用时, 超出时间限制时记为 None
+    assert sandbox._search_many([("(a+)+$", 0)], "a" * 20 + "b", 0.001) == [None]
+
+
+@pytest.mark.asyncio
+async def test_regex_sandbox_abort(app: App, db):
+    """测试其他匹配超时中断的批次会重新提交, 且结果不写入缓存"""
+    import re
+    import asyncio
+
+    from nonebot_plugin_word_bank3.models import regex_sandbox as sandbox
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    # 整批用时超过单条时间限制, 但每条都在限制内
+    slow = [re.compile(r"(a+)+$|b$")] * 8
+    box = sandbox.RegexSandbox(0.3, 2)
+    try:
+        task = asyncio.create_task(box.search_many(slow, "a" * 19 + "b"))
+        await asyncio.sleep(0.05)
+        bad = [re.compile(r"(a+)+$")]
+        assert await box.search_many(bad, "a" * 40 + "b") == [None]
+        assert await task == [True] * 8
+    finally:
+        box.close()
+
+    async with app.test_server():
+        await WordBank.set(IndexType.group, "1", MatchType.regex, "^hello", "hi", "1")
+
+        async def aborted(patterns, text):
+            raise sandbox.RegexAborted()
+
+        search_many = sandbox.regex_sandbox.search_many
+        sandbox.regex_sandbox.search_many = aborted
+        try:
+            assert not await WordBank.match(IndexType.group, "1", "hello")
+        finally:
+            sandbox.regex_sandbox.search_many = search_many
+        assert await WordBank.match(IndexType.group, "1", "hello")
+
+
+@pytest.mark.asyncio
+async def test_regex_validate(app: App, db):
+    """测试添加正则词条时的检查"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        for key in ["([", "(a+)+$", "^(\\w+\\s?)*$"]:
+            with pytest.raises(ValueError):
+                await WordBank.set(
+                    index_type=IndexType.group,
+                    index_id=1,
+                    match_type=MatchType.regex,
+                    key=key,
+                    answer="regex_validate_test",
+                    creator_id=1,
+                )
+
+        # 存在风险但未达到上限的正则仍可添加
+        _, res = await WordBank.set(
+            index_type=IndexType.group,
+            index_id=1,
+            match_type=MatchType.regex,
+            key="(a|ab)*c",
+            answer="regex_validate_test",
+            creator_id=1,
+        )
+        assert res
+
+
+@pytest.mark.asyncio
+async def test_weighted_rows(app: App):
+    """测试累计权重表"""
+    from types import SimpleNamespace
+
+    from nonebot_plugin_word_bank3.models.match_index import (
+        WeightedRows,
+        weighted_pick,
+    )
+
+    a, b, c = (SimpleNamespace(weight=w) for w in (1, 9, 5))
+    table = WeightedRows([a, b])
+    assert table.total == 10
+    assert table.pick(0) is a
+    assert table.pick(0.99) is a
+    assert table.pick(1) is b
+    assert table.pick(9.99) is b
+
+    tables = [table, WeightedRows([c])]
+    assert all(weighted_pick(tables) in (a, b, c) for _ in range(100))
+    assert weighted_pick([]) is None
+
+
+@pytest.mark.asyncio
+async def test_match_cache(app: App, db):
+    """测试匹配结果缓存及写入失效"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_cache import match_cache
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        await WordBank.set(IndexType.group, 1, MatchType.congruence, "你好", "a", 1)
+        res = await WordBank.match(IndexType.group, 1, "你好")
+        assert res and len(res.answer) == 1
+        res = await WordBank.match(IndexType.group, 1, "你好")
+        assert res and len(res.answer) == 1
+        assert match_cache.hits == 1
+
+        # 未命中的结果同样缓存
+        assert not await WordBank.match(IndexType.group, 1, "再见")
+        assert not await WordBank.match(IndexType.group, 1, "再见")
+        assert match_cache.hits == 2
+
+        # 其他会话的写入不影响缓存
+        await WordBank.set(IndexType.group, 2, MatchType.congruence, "再见", "b", 1)
+        assert not await WordBank.match(IndexType.group, 1, "再见")
+        assert match_cache.hits == 3
+
+        # 本会话与全局的写入使缓存失效
+        await WordBank.set(IndexType.group, 1, MatchType.include, "好", "c", 1)
+        res = await WordBank.match(IndexType.group, 1, "你好")
+        assert res and len(res.answer) == 2
+        await WordBank.set(IndexType._global, 1, MatchType.congruence, "再见", "d", 1)
+        res = await WordBank.match(IndexType.group, 1, "再见")
+        assert res and len(res.answer) == 1
+
+        await WordBank.delete_by_key(IndexType.group, 1, "好", MatchType.include)
+        res = await WordBank.match(IndexType.group, 1, "你好")
+        assert res and len(res.answer) == 1
+
+        await WordBank.clear(1, IndexType.group)
+        assert not await WordBank.match(IndexType.group, 1, "你好")
+        assert match_cache.hits == 3
+
+
+@pytest.mark.asyncio
+async def test_revision_log(app: App, db):
+    """测试多进程写入同步"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.revision import (
+        WordBankRevision,
+        revision_log,
+    )
+    from nonebot_plugin_word_bank3.models.match_index import match_index
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        await revision_log.start()
+        revision_log.interval = 0
+        await WordBank.set(IndexType.group, 1, MatchType.congruence, "你好", "a", 1)
+        assert await WordBank.match(IndexType.group, 1, "你好")
+        key = (IndexType.group.value, "1", False)
+        assert match_index.get(key) is not None
+        version = match_index.version(key)
+
+        # 本进程的写入不会丢弃缓存
+        await WordBank.set(IndexType.group, 1, MatchType.congruence, "早", "b", 1)
+        assert await WordBank.match(IndexType.group, 1, "早")
+        assert match_index.version(key)[0] == version[0]
+
+        # 其他进程的写入
+        ans = await WordBankData.create(answer="c")
+        await WordBank.create(
+            index_type=IndexType.group.value,
+            index_id="1",
+            match_type=MatchType.congruence.value,
+            key="晚安",
+            answer_id=ans.id,
+            creator_id="2",
+            last_ans="",
+        )
+        await WordBankRevision.create(
+            index_type=IndexType.group.value,
+            index_id="1",
+            require_to_me=False,
+            match_type=MatchType.congruence.value,
+            key="晚安",
+            origin="other",
+        )
+        res = await WordBank.match(IndexType.group, 1, "晚安")
+        assert res and res.answer[0].answer == "c"
+
+        # 全部清空
+        await WordBank.clear()
+        await WordBankRevision.filter(origin=revision_log.origin).delete()
+        await WordBank.set(IndexType.group, 1, MatchType.congruence, "你好", "a", 1)
+        assert await WordBank.match(IndexType.group, 1, "你好")
+        await WordBank.all().delete()
+        await WordBankRevision.create(origin="other")
+        assert not await WordBank.match(IndexType.group, 1, "你好")
+
+
+@pytest.mark.asyncio
+async def test_revision_prune(app: App, db):
+    """测试长时间运行时定期清理写入记录"""
+    from datetime import timedelta
+
+    from tortoise import timezone
+
+    from nonebot_plugin_word_bank3.models.revision import (
+        WordBankRevision,
+        revision_log,
+    )
+
+    async with app.test_server():
+        await revision_log.start()
+        old = timezone.now() - timedelta(seconds=revision_log.retention + 60)
+        await revision_log.touch(1, "1")
+        await WordBankRevision.all().update(create_time=old)
+
+        # 距上次清理不足间隔时不清理
+        await revision_log.poll()
+        assert await WordBankRevision.all().count() == 1
+
+        revision_log._pruned -= 3600
+        await revision_log.poll()
+        assert await WordBankRevision.all().count() == 0
+
+
+@pytest.mark.asyncio
+async def test_index_snapshot(app: App, db):
+    """测试索引快照写时复制"""
+    import asyncio
+    from types import SimpleNamespace
+
+    from nonebot_plugin_word_bank3.models import match_index as module
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import IndexBucket, match_index
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    def row(id: int, match_type: MatchType, key: str):
+        return SimpleNamespace(id=id, match_type=match_type.value, key=key, weight=1)
+
+    old = IndexBucket(
+        [row(1, MatchType.congruence, "a"), row(2, MatchType.include, "b")]
+    )
+    new = old.evolve(added=[row(3, MatchType.congruence, "a")], removed=[2])
+    # 原快照不变, 未变化的自动机直接共用
+    assert len(old.match("a")[0]) == 1 and old.match("xbx")
+    assert len(new.match("a")[0]) == 2 and not new.match("xbx")
+    assert new.regex_prefilter is old.regex_prefilter
+    assert new.evolve(added=[row(4, MatchType.congruence, "c")]).include is new.include
+
+    async with app.test_server():
+        # 在线程池中构建, 并发写入均生效
+        module._BACKGROUND_BUILD = 0
+        negative_filter.reset()
+        assert not await WordBank.match(IndexType.group, 1, "你好")
+        bucket = match_index.get((IndexType.group.value, "1", False))
+        await asyncio.gather(
+            *(
+                WordBank.set(IndexType.group, 1, MatchType.congruence, "你好", str(i), 1)
+                for i in range(5)
+            )
+        )
+        assert bucket is not None and not len(bucket)
+        res = await WordBank.match(IndexType.group, 1, "你好")
+        assert res and len(res.answer) == 5
+
+
+@pytest.mark.asyncio
+async def test_index_eviction(app: App, db):
+    """测试不活跃索引的淘汰"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import bucket_key, match_index
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        negative_filter.reset()
+        match_index.max_buckets = 4
+        for i in range(3):
+            await WordBank.set(IndexType.group, i, MatchType.congruence, "你好", "a", 1)
+            assert await WordBank.match(IndexType.group, i, "你好")
+
+        # 每个会话加载 @ 与非 @ 两份索引, 最早的会话被淘汰, 全局词库不受影响
+        assert bucket_key(IndexType.group, 0) not in match_index
+        assert bucket_key(IndexType.group, 1) in match_index
+        assert bucket_key(IndexType._global, 0) in match_index
+
+        # 使用过的索引不会被优先淘汰
+        assert not await WordBank.match(IndexType.group, 0, "早")
+        assert bucket_key(IndexType.group, 2) in match_index
+        assert bucket_key(IndexType.group, 1) not in match_index
+
+        # 按词条数淘汰
+        match_index.max_buckets = 0
+        match_index.max_rows = 1
+        assert not await WordBank.match(IndexType.group, 1, "早")
+        assert bucket_key(IndexType.group, 0) not in match_index
+        assert bucket_key(IndexType.group, 2) not in match_index
+        assert bucket_key(IndexType.group, 1) in match_index
+
+
+@pytest.mark.asyncio
+async def test_index_entry(app: App, db):
+    """测试内存索引中的词条"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import (
+        Entry,
+        bucket_key,
+        match_index,
+    )
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        negative_filter.reset()
+        for key in ("你好", "早"):
+            await WordBank.set(
+                IndexType.group, 10001, MatchType.congruence, key, "a", 1
+            )
+        res = await WordBank.random_answer(IndexType.group, 10001, "你好")
+        assert res and res.answer == "a"
+
+        bucket = match_index.get(bucket_key(IndexType.group, 10001))
+        assert bucket is not None
+        a, b = bucket.rows.values()
+        assert isinstance(a, Entry) and not hasattr(a, "__dict__")
+        assert a.index_id is b.index_id
+
+
+@pytest.mark.asyncio
+async def test_global_shared(app: App, db):
+    """测试全局词库对所有会话共用"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_index import bucket_key, match_index
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    assert bucket_key(IndexType._global, 1) == bucket_key(IndexType._global, 2)
+
+    async with app.test_server():
+        negative_filter.reset()
+        await WordBank.set(IndexType._global, 1, MatchType.congruence, "你好", "a", 1)
+        await WordBank.set(IndexType._global, 2, MatchType.include, "早", "b", 1)
+
+        res = await WordBank.match(IndexType.group, 3, "你好")
+        assert res and res.answer[0].answer == "a"
+        bucket = match_index.get(bucket_key(IndexType._global, 0))
+        assert bucket is not None and len(bucket) == 2
+
+        # 其他会话直接使用已加载的全局词库
+        res = await WordBank.match(IndexType.private, 4, "早上好")
+        assert res and res.answer[0].answer == "b"
+        assert match_index.get(bucket_key(IndexType._global, 0)) is bucket
+
+        # 全局词库的写入对所有会话生效
+        await WordBank.delete_by_key(IndexType._global, 1, "你好")
+        assert not await WordBank.match(IndexType.group, 3, "你好")
+        assert not await WordBank.match(IndexType.private, 4, "你好")
+
+
+@pytest.mark.asyncio
+async def test_match_policy(app: App, db):
+    """测试匹配结果取舍方式"""
+    from nonebot_plugin_word_bank3.models import word_bank as module
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.match_cache import match_cache
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async def answers(key: str):
+        match_cache.invalidate()
+        res = await WordBank.match(IndexType.group, 1, key)
+        return sorted(ans.answer for ans in res.answer) if res else []
+
+    async with app.test_server():
+        await WordBank.set(IndexType.group, 1, MatchType.congruence, "你好", "a", 1)
+        await WordBank.set(IndexType.group, 1, MatchType.include, "好", "b", 1)
+        await WordBank.set(IndexType._global, 1, MatchType.congruence, "你好", "c", 1)
+        await WordBank.set(IndexType._global, 1, MatchType.regex, "^你.$", "d", 1)
+
+        assert module.plugin_config.wordbank_match_policy == "union"
+        assert await answers("你好") == ["a", "b", "c", "d"]
+
+        module.plugin_config.wordbank_match_policy = "tier"
+        assert await answers("你好") == ["a", "c"]
+        assert await answers("很好") == ["b"]
+        assert await answers("你们") == ["d"]
+
+        module.plugin_config.wordbank_match_policy = "session"
+        assert await answers("你好") == ["a", "b"]
+        assert await answers("你们") == ["d"]
+
+
+@pytest.mark.asyncio
+async def test_normalize_message(app: App):
+    """测试消息预处理"""
+    from nonebot.adapters.onebot.v11 import Message
+    from nonebot.adapters.onebot.v11.event import Sender, GroupMessageEvent
+
+    from nonebot_plugin_word_bank3.utils import strip_nickname, normalize_message
+
+    assert strip_nickname("小白你好", ["小白"]) == ("你好", True)
+    assert strip_nickname("你好小白", ["小白"]) == ("你好小白", False)
+    assert strip_nickname("你好", [""]) == ("你好", False)
+
+    event = GroupMessageEvent(
+        time=0,
+        self_id=0,
+        post_type="message",
+        sub_type="normal",
+        user_id=123,
+        group_id=456,
+        message_type="group",
+        message_id=0,
+        message=Message("小白 [&]"),
+        raw_message="小白 [&]",
+        font=0,
+        sender=Sender(),
+        to_me=True,
+    )
+    message = normalize_message(event)
+    assert message.text == "小白 &#91;&amp;&#93;"
+    assert message.unescaped == "小白 [&]"
+    assert message.to_me
+
+
+@pytest.mark.asyncio
+async def test_router(app: App):
+    """测试命令分发"""
+    from types import SimpleNamespace
+
+    from nonebot.params import RegexGroup
+    from nonebot.matcher import Matcher
+    from nonebot.permission import Permission
+    from nonebot.adapters.onebot.v11 import Message
+    from nonebot.adapters.onebot.v11.event import Sender, PrivateMessageEvent
+
+    from nonebot_plugin_word_bank3.router import ROUTE_KEY, Router
+
+    def event(text: str):
+        return PrivateMessageEvent(
+            time=0,
+            self_id=0,
+            post_type="message",
+            sub_type="friend",
+            user_id=123,
+            message_type="private",
+            message_id=0,
+            message=Message(text),
+            raw_message=text,
+            font=0,
+            sender=Sender(),
+        )
+
+    async def deny() -> bool:
+        return False
+
+    called = []
+    router = Router()
+
+    @router.route(("问",), r"^问(.+)答(.+)$", Permission())
+    @router.route(("问",), r"^问(.+)答(.+)$", Permission(deny))
+    async def _(matched=RegexGroup()):
+        called.append(matched)
+
+    router.add(("删除",), r"^删除(.+)$", Permission())
+    bot = SimpleNamespace(config=SimpleNamespace(nickname=set()))
+
+    state = {}
+    assert not await router.rule(bot, event("你好"), state)  # type: ignore
+    assert not await router.rule(bot, event("问你好"), state)  # type: ignore
+    assert not state
+
+    # 无权限的命令被跳过
+    assert await router.rule(bot, event("问你好答早"), state)  # type: ignore
+    assert state[ROUTE_KEY] is router.routes[1]
+    await router.handle(Matcher(), bot, event("问你好答早"), state)  # type: ignore
+    assert called == [("你好", "早")]
+
+    # 没有处理函数的命令只拦截消息
+    state = {}
+    assert await router.rule(bot, event("删除你好"), state)  # type: ignore
+    await router.handle(Matcher(), bot, event("删除你好"), state)  # type: ignore
+    assert len(called) == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_set(app: App, db):
+    """测试批量添加词条"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import (
+        IndexType,
+        MatchType,
+        NewWordEntry,
+    )
+
+    def entries(n: int, **kwargs):
+        for i in range(n):
+            yield NewWordEntry(
+                **{
+                    "index_type": IndexType.group,
+                    "index_id": "1",
+                    "key": f"问{i}",
+                    "answer": f"答{i}",
+                    "creator_id": "1",
+                    **kwargs,
+                }
+            )
+
+    async with app.test_server():
+        id, _ = await WordBank.set(
+            IndexType.group, 1, MatchType.congruence, "a", "b", 1
+        )
+        assert not await WordBank.match(IndexType.group, 1, "问0")
+
+        ids = await WordBank.bulk_set(entries(25), chunk_size=10)
+        assert ids == list(range(id + 1, id + 26))
+        res = await WordBank.match(IndexType.group, 1, "问24")
+        assert res and res.answer[0].answer == "答24" and res.answer[0].id == ids[-1]
+
+        # 任一词条有误时全部不添加
+        with pytest.raises(ValueError, match="权重必须为 1~10 的整数"):
+            await WordBank.bulk_set(entries(3, weight=11))
+        with pytest.raises(ValueError, match="第 1 条"):
+            await WordBank.bulk_set(
+                entries(3, match_type=MatchType.regex, key="(a+)+$")
+            )
+        assert await WordBank.all().count() == 26
+        assert await WordBankData.all().count() == 26
+
+        # 之后的单条添加继续使用自增ID
+        new_id, _ = await WordBank.set(
+            IndexType.group, 1, MatchType.congruence, "c", "d", 1
+        )
+        assert new_id == ids[-1] + 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_set_revision(app: App, db):
+    """测试批量添加时每个索引只写一条写入记录"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.revision import (
+        WordBankRevision,
+        revision_log,
+    )
+    from nonebot_plugin_word_bank3.models.match_index import bucket_key
+    from nonebot_plugin_word_bank3.models.negative_filter import negative_filter
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, NewWordEntry
+
+    async with app.test_server():
+        await revision_log.start()
+        revision_log.interval = 0
+        await WordBank.build_negative_filter()
+        await WordBank.bulk_set(
+            NewWordEntry(
+                index_type=IndexType.group,
+                index_id=str(i % 2),
+                key=f"问{i}",
+                answer="答",
+                creator_id="1",
+            )
+            for i in range(300)
+        )
+        assert await WordBankRevision.all().count() == 2
+
+        # 其他进程不逐条同步问句, 而是把索引视为可能匹配
+        await WordBank.build_negative_filter()
+        key = bucket_key(IndexType.group, "1")
+        assert not negative_filter.may_match(key, "wtf")
+        revision_log.origin = "other"
+        await revision_log.poll()
+        assert negative_filter.may_match(key, "wtf")
+        assert negative_filter.may_match(bucket_key(IndexType.group, "0"), "wtf")
+        assert not negative_filter.may_match(bucket_key(IndexType.group, "2"), "wtf")
+
+
+@pytest.mark.asyncio
+async def test_bulk_set_id(app: App, db):
+    """测试批量添加不复用已删除词条和答句的ID"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, NewWordEntry
+
+    def entry(answer: str) -> NewWordEntry:
+        return NewWordEntry(
+            index_type=IndexType.group,
+            index_id="1",
+            key="问",
+            answer=answer,
+            creator_id="1",
+        )
+
+    async with app.test_server():
+        first, last = await WordBank.bulk_set([entry("答1"), entry("答2")])
+        answer_id = (await WordBank.get(id=last)).answer_id
+        await WordBank.delete_by_key_id(IndexType.group, "1", last)
+        (id,) = await WordBank.bulk_set([entry("答3")])
+        assert id > last
+        assert (await WordBank.get(id=id)).answer_id > answer_id
+
+
+@pytest.mark.asyncio
+async def test_import_file(app: App, db, tmp_path):
+    """测试导入词库文件"""
+    import json
+
+    from nonebot_plugin_word_bank3.utils import parse_key_flags
+    from nonebot_plugin_word_bank3.transfer import ImportProgress, import_file
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    assert parse_key_flags("qgzz^a$") == ("^a$", True, MatchType.regex, False)
+    assert parse_key_flags("@mh早") == ("早", False, MatchType.include, True)
+    assert parse_key_flags("你好mh") == ("你好mh", False, MatchType.congruence, False)
+
+    jsonl = tmp_path / "bank.jsonl"
+    lines = [
+        {"key": "你好", "answer": "a"},
+        {"key": "qg早", "answer": "b"},
+        {"key": "mh晚安", "answer": "c", "weight": 5},
+        {"key": "zz(a+)+$", "answer": "d"},
+        {"key": "缺少答句"},
+        {"key": "mh", "answer": "spam"},
+    ]
+    jsonl.write_text(
+        "\n".join([*(json.dumps(line) for line in lines), "{", ""]), encoding="utf-8"
+    )
+    csv_file = tmp_path / "bank.csv"
+    csv_file.write_text(
+        "key,answer,match_type,weight\n^再见$,正则,3,10\n权重,x,1,11\n",
+        encoding="utf-8",
+    )
+
+    async with app.test_server():
+        progress = ImportProgress()
+        reports = [
+            p.imported
+            async for p in import_file(
+                jsonl, IndexType.group, "1", "1", progress, batch_size=2
+            )
+        ]
+        assert reports == [2, 3]
+        assert progress.skipped == 4
+        assert [e.split(":")[0] for e in progress.errors] == [
+            "第 4 行",
+            "第 5 行",
+            "第 6 行",
+            "第 7 行",
+        ]
+        assert progress.errors[2] == "第 6 行: 问句不能为空"
+        assert not await WordBank.match(IndexType.group, 1, "随便什么")
+
+        assert await WordBank.match(IndexType.group, 1, "你好")
+        assert await WordBank.match(IndexType.private, 2, "早")
+        res = await WordBank.match(IndexType.group, 1, "晚安啦")
+        assert res and res.answer[0].weight == 5
+
+        progress = ImportProgress()
+        async for _ in import_file(csv_file, IndexType.group, "1", "1", progress):
+            pass
+        assert progress.imported == 1 and progress.skipped == 1
+        assert progress.errors == ["第 3 行: 权重必须为 1~10 的整数"]
+        assert await WordBank.match(IndexType.group, 1, "再见")
+
+
+@pytest.mark.asyncio
+async def test_export_file(app: App, db, tmp_path):
+    """测试分页导出词库"""
+    import json
+
+    from nonebot_plugin_word_bank3.transfer import (
+        ImportProgress,
+        export_file,
+        import_file,
+    )
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.typing_models import IndexType, MatchType
+
+    async with app.test_server():
+        await WordBank.set(IndexType.group, "1", MatchType.congruence, "你好", "a", "1")
+        await WordBank.set(
+            IndexType.group, "1", MatchType.include, "晚安", "b", "1", True, 5
+        )
+        await WordBank.set(IndexType.group, "2", MatchType.congruence, "你好", "c", "1")
+        await WordBank.set(IndexType._global, "1", MatchType.regex, "^早", "d", "1")
+
+        path = tmp_path / "group_1.jsonl"
+        counts = [
+            n async for n in export_file(path, IndexType.group, "1", chunk_size=1)
+        ]
+        assert counts == [1, 2]
+        rows = [json.loads(line) for line in path.read_text("utf-8").splitlines()]
+        assert [(r["key"], r["answer"]) for r in rows] == [("你好", "a"), ("晚安", "b")]
+        assert rows[1]["match_type"] == MatchType.include.value
+        assert rows[1]["require_to_me"] is True and rows[1]["weight"] == 5
+        assert not list(tmp_path.glob("*.part"))
+
+        path = tmp_path / "all.jsonl"
+        assert [n async for n in export_file(path)] == [4]
+
+        # 导出的文件可以直接导入
+        await WordBank.clear()
+        progress = ImportProgress()
+        async for _ in import_file(path, IndexType.private, "9", "9", progress):
+            pass
+        assert progress.imported == 4 and progress.skipped == 0
+        assert await WordBank.match(IndexType.group, "2", "你好")
+        assert await WordBank.match(IndexType.private, "3", "早上好")
+        assert not await WordBank.match(IndexType.group, "1", "晚安")
+        assert await WordBank.match(IndexType.group, "1", "晚安", to_me=True)
+
+
+@pytest.mark.asyncio
+async def test_batch_delete(app: App, db):
+    """测试分块批量删除"""
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import (
+        IndexType,
+        MatchType,
+        NewWordEntry,
+    )
+
+    def entry(index_id: str, key: str, **kwargs) -> NewWordEntry:
+        return NewWordEntry(
+            **{
+                "index_type": IndexType.group,
+                "index_id": index_id,
+                "key": key,
+                "answer": key,
+                "creator_id": "1",
+                **kwargs,
+            }
+        )
+
+    async with app.test_server():
+        ids = await WordBank.bulk_set(
+            [entry("1", f"问{i}") for i in range(1200)]
+            + [entry("1", "重复"), entry("1", "重复"), entry("1", "重复", weight=1)]
+            + [entry("1", "模糊", match_type=MatchType.include)]
+            + [entry("2", "你好")]
+        )
+        assert await WordBank.match(IndexType.group, "1", "问0")
+        assert await WordBank.match(IndexType.group, "1", "重复")
+
+        answer_ids, ok = await WordBank.delete_by_key(IndexType.group, "1", "重复")
+        assert ok and len(answer_ids) == 3
+        assert not await WordBank.filter(answer_id__in=answer_ids).exists()
+        assert not await WordBankData.filter(id__in=answer_ids).exists()
+        assert not await WordBank.match(IndexType.group, "1", "重复")
+        assert await WordBank.delete_by_key(IndexType.group, "1", "重复") == ([], False)
+
+        answer_ids = [
+            wb.answer_id for wb in await WordBank.filter(key__in=["问1", "问2"])
+        ]
+        await WordBank.delete_by_answer_id(answer_ids)
+        assert not await WordBank.match(IndexType.group, "1", "问1")
+
+        # 答句在会话间共享, 指定索引时只删除该会话的词条
+        await WordBank.set(
+            IndexType.group, "2", MatchType.congruence, "共享", "共享答", "10000"
+        )
+        await WordBank.set(
+            IndexType.group, "3", MatchType.congruence, "共享", "共享答", "10000"
+        )
+        shared = {wb.answer_id for wb in await WordBank.filter(key="共享")}
+        assert len(shared) == 1
+        await WordBank.delete_by_answer_id(list(shared), IndexType.group, "2")
+        assert not await WordBank.match(IndexType.group, "2", "共享")
+        assert await WordBank.match(IndexType.group, "3", "共享")
+        await WordBank.clear("3", IndexType.group)
+        assert await WordBank.filter(index_id="1").count() == 1198 + 1
+
+        # 只清空指定匹配类型
+        assert await WordBank.clear("1", IndexType.group, MatchType.include)
+        assert not await WordBank.match(IndexType.group, "1", "很模糊")
+        assert await WordBank.match(IndexType.group, "1", "问3")
+
+        assert await WordBank.clear("1", IndexType.group)
+        assert not await WordBank.filter(index_id="1").exists()
+        assert not await WordBank.match(IndexType.group, "1", "问4")
+        assert await WordBankData.all().count() == 1
+        assert await WordBank.match(IndexType.group, "2", "你好")
+        assert len(ids) == 1205
+
+
+@pytest.mark.asyncio
+async def test_answer_dedup(app: App, db):
+    """测试相同内容的答句只保存一份"""
+    from tortoise import Tortoise
+    from tortoise.transactions import in_transaction
+
+    from nonebot_plugin_word_bank3.models.migration import MIGRATIONS
+    from nonebot_plugin_word_bank3.models.word_bank import WordBank
+    from nonebot_plugin_word_bank3.models.word_bank_data import WordBankData
+    from nonebot_plugin_word_bank3.models.typing_models import (
+        IndexType,
+        MatchType,
+        NewWordEntry,
+    )
+
+    async with app.test_server():
+        for index_id in ("1", "2"):
+            await WordBank.set(
+                IndexType.group, index_id, MatchType.congruence, "你好", "哈哈", "1"
+            )
+        await WordBank.bulk_set(
+            NewWordEntry(
+                index_type=IndexType.group,
+                index_id="3",
+                key=key,
+                answer=answer,
+                creator_id="1",
+            )
+            for key, answer in [("你好", "哈哈"), ("早", "新答句"), ("晚", "新答句")]
+        )
+        assert await WordBankData.all().count() == 2
+        (answer_id,) = {wb.answer_id for wb in await WordBank.filter(key="你好")}
+
+        # 写时复制: 只修改本会话的词条
+        assert await WordBank.update_answer(
+            [answer_id], "嘿嘿", IndexType.group, "1"
+        ) == ([answer_id], True)
+        res = await WordBank.match(IndexType.group, "1", "你好")
+        assert res and res.answer[0].answer == "嘿嘿"
+        res = await WordBank.match(IndexType.group, "2", "你好")
+        assert res and res.answer[0].answer == "哈哈"
+        assert await WordBank.update_answer([answer_id], "x", IndexType.private) == (
+            [],
+            False,
+        )
+
+        # 回退后答句与 last_ans 互换
+        assert await WordBank.last_ans_return(IndexType.group, "1", "你好") == [answer_id]
+        res = await WordBank.match(IndexType.group, "1", "你好")
+        assert res and res.answer[0].answer == "哈哈"
+        assert not await WordBankData.filter(answer="嘿嘿").exists()
+
+        # 答句在不再被引用时才删除
+        await WordBank.delete_by_key(IndexType.group, "1", "你好")
+        await WordBank.clear("2", IndexType.group)
+        assert await WordBankData.filter(id=answer_id).exists()
+        await WordBank.delete_by_key(IndexType.group, "3", "你好")
+        assert not await WordBankData.filter(id=answer_id).exists()
+        assert await WordBankData.all().count() == 1
+
+        # 迁移合并已有的重复答句, 并删除无引用的答句
+        conn = Tortoise.get_connection("default")
+        await conn.execute_query("DROP INDEX idx_wordbank3_data_hash")
+        await WordBankData.bulk_create(
+            [WordBankData(id=i, answer=a) for i, a in [(11, "旧"), (12, "旧"), (13, "孤")]]
+        )
+        for wb_id, data_id in [(21, 11), (22, 12)]:
+            await WordBank.create(
+                id=wb_id,
+                index_type=IndexType.group.value,
+                index_id="4",
+                key=f"旧{wb_id}",
+                answer_id=data_id,
+                creator_id="1",
+                last_ans="旧",
+            )
+        async with in_transaction("default") as tx:
+            await MIGRATIONS[2](tx)
+        assert {wb.answer_id for wb in await WordBank.filter(index_id="4")} == {11}
+        assert not await WordBankData.filter(id__in=[12, 13]).exists()
+        assert await WordBankData.filter(hash__isnull=True).count() == 0
+        _, rows = await conn.execute_query("PRAGMA index_list(wordbank3_data)")
+        assert "idx_wordbank3_data_hash" in {row["name"] for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_hash_command_inert(app: App):
+    """测试 # 命令不会把消息当作问答添加"""
+    from nonebot.adapters.onebot.v11 import Bot, Adapter, Message
+    from nonebot.adapters.onebot.v11.event import Sender, PrivateMessageEvent
+
+    from nonebot_plugin_word_bank3 import wb_router
+
+    # 数据库未连接, 如果被当作问答添加会在处理时出错
+    async with app.test_matcher(wb_router) as ctx:
+        adapter = ctx.create_adapter(base=Adapter)
+        bot = ctx.create_bot(base=Bot, adapter=adapter)
+        event = PrivateMessageEvent(
+            time=0,
+            self_id=0,
+            post_type="message",
+            sub_type="friend",
+            user_id=123,
+            message_type="private",
+            message_id=0,
+            message=Message("#abc def"),
+            raw_message="#abc def",
+            font=0,
+            sender=Sender(),
+        )
+        ctx.receive_event(bot, event)
+        ctx.should_call_send(event, "", True)
+        ctx.should_finished()